@@ -1 +1,6 @@
-from .gui import *
+from .pipeline import *
+try:
+    from .gui import *
+except ModuleNotFoundError as e:    # Headless use, wxPython not installed
+    if e.name != 'wx':
+        raise
@@ -0,0 +1,257 @@
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import time
+import timeit
+
+from .pipeline import Pipeline, to_8bit, to_rgb, top_px, top_px_avg
+from .processing import (
+    ColorProcessor, FlatField, FringeAnalyzer, FringeEstimator, RollingSum,
+    colormap_variant, decimate_roi, draw_lines)
+from .synthetic import fringe_image, gradient_image
+
+
+# Constants -------------------------------------------------------------------
+
+RESOLUTIONS = {             # (h, w) of sensor images
+    '480p': (480, 640),
+    '800p': (800, 1280),
+    '1080p': (1080, 1920)}
+DTYPES = (np.uint8, np.uint16)
+RESULTS_DIR = 'benchmarks'
+THRESHOLD = 1.2             # Slowdown ratio reported as a regression
+
+
+# Test images -----------------------------------------------------------------
+
+def make_image(shape, dtype=np.uint8, color=False):
+    ''' Fringe test image, with different patterns per channel if color '''
+    img = fringe_image(shape, dtype, count=20, tilt=30)
+    if color:
+        img = np.dstack((
+            img, gradient_image(shape, dtype),
+            fringe_image(shape, dtype, count=5, tilt=-60)))
+    return img
+
+
+# Benchmark cases -------------------------------------------------------------
+# Each case is (name, function), where function takes no arguments. Inputs
+# and outputs are prepared outside the function, so only the stage is timed.
+
+def sensor_cases(res, dtype, color):
+    ''' Full-resolution stages, on sensor images '''
+    shape = RESOLUTIONS[res]
+    img = make_image(shape, dtype, color)
+    size = (shape[1] // 2, shape[0] // 2)   # Display (w, h)
+    tag = '/{}/{}/{}'.format(res, np.dtype(dtype).name,
+                             'color' if color else 'mono')
+    cases = []
+    if dtype == np.uint16:
+        out8 = np.empty(img.shape, np.uint8)
+        cases.append(('to_8bit' + tag, lambda: to_8bit(img, out8)))
+    resized = np.empty(size[::-1] + img.shape[2:], dtype)
+    cases.append(('resize' + tag, lambda: cv2.resize(
+        img, size, resized, interpolation=cv2.INTER_AREA)))
+    flat = FlatField(make_image(shape, dtype, color) // 8)
+    cases.append(('flatfield' + tag, lambda: flat.flatfield_img(img)))
+    gain = FlatField(
+        flat.ff.astype(np.float32), make_image(shape, dtype, color) / 2 + 1,
+        'divide', dtype)
+    cases.append(('flatfield_divide' + tag, lambda: gain.flatfield_img(img)))
+    summer = RollingSum(10)
+    for i in range(10):
+        summer.add(img)
+    cases.append(('sum' + tag, lambda: summer.add(img)))
+    if not color:
+        cases.append(('top_px' + tag, lambda: top_px(img)))
+        cases.append(('top_px_avg' + tag, lambda: top_px_avg(img)))
+    pipeline = Pipeline(size=size)
+    cases.append(('pipeline' + tag, lambda: pipeline.process_img(img)))
+    # Display color processing, 16-bit images dropping bits or not
+    processes = {'full': [], 'resized': [ColorProcessor(
+        range_val=255, gamma_val=2.2, fused=True).process_img]}
+    for high_bit in (False, True) if dtype == np.uint16 else (False,):
+        pipeline = Pipeline(processes, size, high_bit=high_bit)
+        cases.append((
+            'pipeline_color' + ('_high_bit' if high_bit else '') + tag,
+            lambda p=pipeline: p.process_img(img)))
+    # Fringe analysis on a fixed-size decimated region of the sensor image
+    estimator = FringeEstimator()
+    roi = (0.25, 0.25, 0.75, 0.75)
+    cases.append(('fringes_roi' + tag, lambda: estimator.analyze(
+        decimate_roi(img, roi))))
+    # Highlight from full-resolution frames (float value, as from the GUI)
+    color_processor = ColorProcessor(sat_val=250., sat_full=True)
+    pipeline = Pipeline({
+        'full': [color_processor.find_sat_full],
+        'resized': [color_processor.process_img]}, size)
+    cases.append((
+        'pipeline_sat_full' + tag, lambda: pipeline.process_img(img)))
+    # Gray and false color views side by side from one resized image
+    pipeline = Pipeline(size=size)
+    pipeline.variants = [colormap_variant(1), colormap_variant(9)]
+    cases.append(('pipeline_split' + tag, lambda: pipeline.process_img(img)))
+    return cases
+
+
+def display_cases(res, color):
+    ''' Display-size stages, on 8-bit images at half the sensor resolution '''
+    h, w = RESOLUTIONS[res]
+    img = make_image((h // 2, w // 2), np.uint8, color)
+    tag = '/{}/uint8/{}'.format(res, 'color' if color else 'mono')
+    rgb = np.empty(img.shape[:2] + (3,), np.uint8)
+    cases = [('to_rgb' + tag, lambda: to_rgb(img, rgb))]
+    # Values are floats, as ColorPanel passes them from its text fields
+    settings = {
+        'range': {'range_val': 200.},
+        'auto_contrast': {'range_val': 255., 'auto_clip': 0.5},
+        'gamma': {'gamma_val': 2.2},
+        'colormap': {'colormap': 9},
+        'saturation': {'sat_val': 250.},
+        'range_saturation': {'range_val': 200., 'sat_val': 250.},
+        'all': {'range_val': 200., 'gamma_val': 2.2, 'colormap': 9,
+                'sat_val': 250.}}
+    for name, kwargs in settings.items():
+        if color and 'colormap' in kwargs:
+            continue            # OpenCV colormaps need mono images
+        for fused in (False, True):
+            color_processor = ColorProcessor(fused=fused, **kwargs)
+            cases.append((
+                'color_' + name + ('_fused' if fused else '') + tag,
+                lambda p=color_processor: p.process_img(img.copy())))
+    lines = img.copy()
+    cases.append(('draw_lines' + tag, lambda: draw_lines(lines, 200)))
+    if not color:
+        analyzer = FringeAnalyzer()
+        cases.append(('fringes' + tag, lambda: analyzer.analyze(img)))
+        estimator = FringeEstimator()
+        cases.append((
+            'fringes_estimator' + tag, lambda: estimator.analyze(img)))
+    return cases
+
+
+def all_cases(resolutions=RESOLUTIONS):
+    cases = []
+    for res in resolutions:
+        for dtype in DTYPES:
+            for color in (False, True):
+                cases.extend(sensor_cases(res, dtype, color))
+        for color in (False, True):
+            cases.extend(display_cases(res, color))
+    return cases
+
+
+# Running ---------------------------------------------------------------------
+
+def run_case(function, repeat=5, min_time=0.2):
+    ''' Return per-call time statistics of function, in microseconds '''
+    timer = timeit.Timer(function)
+    number, t = timer.autorange()
+    number = max(1, int(number * min_time / t)) if t else number
+    times = np.array(timer.repeat(repeat, number)) / number * 1e6
+    return {
+        'number': number, 'min_us': float(times.min()),
+        'median_us': float(np.median(times))}
+
+
+def git_revision():
+    ''' Return short git revision of this package, or None '''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cases, repeat=5, verbose=True):
+    ''' Run benchmark cases, return results dict (see save_results) '''
+    results = {}
+    for name, function in cases:
+        results[name] = run_case(function, repeat)
+        if verbose:
+            print('{:<40}{:>12.1f} us'.format(name, results[name]['min_us']))
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()},
+        'results': results}
+
+
+def save_results(results, drn=RESULTS_DIR):
+    ''' Save results as <drn>/<date>-<time>_<git revision>.json '''
+    os.makedirs(drn, exist_ok=True)
+    fn = os.path.join(drn, '{}_{}.json'.format(
+        time.strftime('%Y%m%d-%H%M%S'), results['meta']['git'] or 'nogit'))
+    with open(fn, 'w') as f:
+        json.dump(results, f, indent=2)
+    return fn
+
+
+def compare(results, old_results, threshold=THRESHOLD):
+    ''' Print ratio of new to old times, return names slower by threshold '''
+    old = old_results['results']
+    slower = []
+    for name, r in results['results'].items():
+        if name not in old:
+            continue
+        ratio = r['min_us'] / old[name]['min_us']
+        flag = ''
+        if ratio >= threshold:
+            flag = 'SLOWER'
+            slower.append(name)
+        elif ratio <= 1 / threshold:
+            flag = 'faster'
+        print('{:<40}{:>8.2f}x {}'.format(name, ratio, flag))
+    return slower
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark image processing stages (no display needed)')
+    parser.add_argument(
+        '-r', '--resolution', action='append', choices=RESOLUTIONS,
+        help='sensor resolution(s) to test, default all')
+    parser.add_argument(
+        '-k', '--filter', default='',
+        help='only run cases whose name contains this string')
+    parser.add_argument(
+        '-n', '--repeat', type=int, default=5, help='repeats per case')
+    parser.add_argument(
+        '-o', '--output', default=RESULTS_DIR,
+        help='directory for result files, "" to not save')
+    parser.add_argument(
+        '-c', '--compare', help='earlier result file to compare against')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=THRESHOLD,
+        help='slowdown ratio counted as a regression')
+    args = parser.parse_args(args)
+
+    cases = [
+        (name, function)
+        for name, function in all_cases(args.resolution or RESOLUTIONS)
+        if args.filter in name]
+    results = run(cases, args.repeat)
+    if args.output:
+        print('Saved', save_results(results, args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        if slower:
+            print('{} regression(s)'.format(len(slower)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -8,17 +8,25 @@ import threading
 import time
 import wx
 
+from .pipeline import (
+    BLUE_PX, BUFFER_POOL, GREEN_PX, RED_PX, AnalysisPool, Frame, LatestQueue,
+    Pipeline, PipelineStats, ThreadedPipeline, process_name, to_rgb, top_px,
+    top_px_avg)
+from .processing import (
+    ColorProcessor, FlatField, FringeEstimator, FringeHistory, RollingSum,
+    average_frames, colormap_variant, decimate_roi, draw_lines,
+    histogram_image, strip_chart)
+from .recording import (
+    CALIBRATION_DIR, CalibrationStore, FrameRecorder, PngWriter, RawWriter,
+    open_recording)
+from .synthetic import frame_bank
+
 
 # Constants -------------------------------------------------------------------
 
 # Math
 PI2 = np.pi / 2
 
-# Colored pixels
-BLUE_PX = np.uint8((255, 0, 0))         # BGR format for OpenCV / NumPy
-GREEN_PX = np.uint8((0, 255, 0))
-RED_PX = np.uint8((0, 0, 255))
-
 # Image directory
 IMG_DIR = os.path.dirname(inspect.getfile(inspect.currentframe())) + "/img/"
 
@@ -58,11 +66,6 @@ def get_dir_name(fn):
     return fn[:fn.rfind('/') + 1]
 
 
-def is_color(img):
-    ''' Return True if image contains a color channel, False otherwise '''
-    return len(img.shape) == 3
-
-
 def make_binding(obj, func):
     ''' Set parameter if given a value, update GUI with returned value '''
 
@@ -100,27 +103,14 @@ def to_float(value):
     return value
 
 
-def to_rgb(img):
-    ''' Convert grayscale or BGR (OpenCV default) to RGB (wx default) '''
-    return cv2.cvtColor(
-        img, cv2.COLOR_BGR2RGB if is_color(img) else cv2.COLOR_GRAY2RGB)
-
-
-def top_px(img, n=1):
-    ''' Return top nth pixel from an image '''
-    return img.max() if n == 1 else np.partition(img.flatten(), -n)[-n]
-
-
-def top_px_avg(img, n=3):
-    ''' Return average of top n pixels from an image '''
-    return img.max() if n == 1 else np.partition(img.flatten(), -n)[-n:].mean()
-
-
 # Devices ---------------------------------------------------------------------
 
-def test_image(shape=SZ_IMAGE[::-1]):   # [::-1] reverses order for NumPy
-    ''' Generate random uint8 image of given shape '''
-    return np.random.randint(0, 256, shape, np.uint8)
+def test_image(shape=SZ_IMAGE[::-1], out=None):  # [::-1] reverses for NumPy
+    ''' Generate random uint8 image of given shape, in out if given '''
+    if out is None:
+        return np.random.randint(0, 256, shape, np.uint8)
+    cv2.randu(out, 0, 256)
+    return out
 
 
 class GuiDevice(object):
@@ -175,12 +165,24 @@ class HybridDevice(GuiDevice):
 
 
 class GuiSensor(GuiDevice):
-    ''' GuiDevice that accepts an image queue '''
+    ''' GuiDevice that accepts an image queue.
+        Fill buffers from self.pool to avoid allocating every frame, and wrap
+        images with frame() so they carry capture time and sequence number.
+        Bare images are still accepted, but can't be checked for gaps. '''
 
-    def __init__(self, img_queue, panels={}):
+    def __init__(self, img_queue, panels={}, pool=None):
         self.img_queue = img_queue
+        self.pool = BUFFER_POOL if pool is None else pool
+        self.sensor_id = type(self).__name__
+        self.seq = 0
         super().__init__(panels)
 
+    def frame(self, img, timestamp=None):
+        ''' Wrap image in a Frame with the next sequence number '''
+        seq = self.seq
+        self.seq = seq + 1
+        return Frame(img, timestamp, seq, self.sensor_id)
+
 
 class TestSensor(GuiSensor):
     ''' Test sensor, fills img_queue with random uint8 data '''
@@ -193,9 +195,14 @@ class TestSensor(GuiSensor):
 
     def _img_loop(self):
         put_image = self.img_queue.put
+        get_buffer = self.pool.get
+        frame = self.frame
+        shape = SZ_IMAGE[::-1]
         while self.running:
             try:
-                put_image(test_image(), timeout=self.timeout)
+                put_image(
+                    frame(test_image(out=get_buffer(shape))),
+                    timeout=self.timeout)
             except queue.Full:
                 pass
 
@@ -220,15 +227,146 @@ class TestImgSensor(TestSensor):
 
     def _img_loop(self):
         put_image = self.img_queue.put
+        img = cv2.imread(self.IMG_PATH, cv2.IMREAD_ANYDEPTH)   # Decode once
+        img.flags.writeable = False     # Same array is sent every frame
+        frame = self.frame
         while self.running:
             try:
-                put_image(
-                    cv2.imread(self.IMG_PATH, cv2.IMREAD_ANYDEPTH),
-                    timeout=self.timeout)
+                put_image(frame(img), timeout=self.timeout)
+            except queue.Full:
+                pass
+
+
+class SyntheticSensor(TestSensor):
+    ''' Test sensor, cycles through a precomputed bank of synthetic frames.
+        Frames are generated once (see synthetic.frame_bank) and sent as
+        read-only arrays, so it can run at thousands of fps.
+        pattern: 'fringes', 'gradient', 'spots' or 'noise'
+        n: number of frames in the bank
+        fps: frame rate limit, 0 for as fast as possible
+        params: passed to the pattern generator (e.g. count, tilt)
+        Add as a source with e.g. functools.partial(SyntheticSensor, ...) '''
+
+    def __init__(self, img_queue, pattern='fringes', n=16,
+                 shape=SZ_IMAGE[::-1], dtype=np.uint8, fps=0, timeout=1,
+                 **params):
+        self.bank = frame_bank(pattern, n, shape, dtype, **params)
+        self.fps = fps
+        super().__init__(img_queue, timeout)
+
+    def _img_loop(self):
+        put_image = self.img_queue.put
+        bank = self.bank
+        n = len(bank)
+        i = 0
+        t_next = 0
+        while self.running:
+            if self.fps:
+                delay = t_next - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                t_next = max(t_next, time.time()) + 1 / self.fps
+            try:
+                put_image(self.frame(bank[i]), timeout=self.timeout)
+                i = (i + 1) % n
             except queue.Full:
                 pass
 
 
+class ReplaySensor(TestSensor):
+    ''' Test sensor, fills img_queue with a recorded session.
+        path: raw video file or PNG series (see recording.open_recording)
+        rate: 'native' to follow recorded timestamps, frames per second, or
+            0 for as fast as possible. PNG series have no timestamps, so
+            'native' plays them as fast as possible.
+        loop: start over after the last frame
+        prefetch: frames read ahead on a background thread
+        Add as a source with e.g. functools.partial(ReplaySensor, path=fn) '''
+
+    def __init__(self, img_queue, path, rate='native', loop=True, prefetch=8,
+                 timeout=1):
+        self.reader = open_recording(path)
+        if not len(self.reader):
+            raise ValueError("No frames found in {}".format(path))
+        self.rate = rate
+        self.loop = loop
+        self.prefetch_queue = queue.Queue(prefetch)
+        self.prefetch_thread = None
+        super().__init__(img_queue, timeout)
+
+    def _prefetch_loop(self):
+        ''' Target process for prefetch thread, reads frames in order '''
+        reader = self.reader
+        timestamps = reader.timestamps
+        get_buffer = self.pool.get
+        put = self.prefetch_queue.put
+        i = 0
+        while self.running:
+            if i == len(reader):
+                if not self.loop:
+                    break
+                i = 0
+            img = reader[i]
+            # Copy read-only (memory-mapped) frames so they can be processed
+            if not img.flags.writeable:
+                buf = get_buffer(img.shape, img.dtype)
+                np.copyto(buf, img)
+                img = buf
+            t = None if timestamps is None else timestamps[i]
+            while self.running:
+                try:
+                    put((i, img, t), timeout=self.timeout)
+                    break
+                except queue.Full:
+                    pass
+            i += 1
+
+    def _img_loop(self):
+        get = self.prefetch_queue.get
+        put_image = self.img_queue.put
+        t_start = t_rec = None      # Wall and recorded time of first frame
+        t_next = 0                  # Wall time of next frame at fixed rate
+        while self.running:
+            try:
+                i, img, t = get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            # Wait until frame is due
+            rate = self.rate
+            now = time.time()
+            if rate == 'native':
+                if t is None:
+                    delay = 0
+                else:
+                    if i == 0 or t_start is None:
+                        t_start, t_rec = now, t
+                    delay = t_start + (t - t_rec) - now
+            elif rate:
+                delay = t_next - now
+                t_next = max(t_next, now) + 1 / rate
+            else:
+                delay = 0
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                put_image(self.frame(img), timeout=self.timeout)
+            except queue.Full:
+                pass
+
+    def start(self):
+        super().start()
+        self.prefetch_thread = threading.Thread(target=self._prefetch_loop)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+        return self.running
+
+    def close(self):
+        super().close()
+        if self.prefetch_thread:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+
+
 # wx.Dialog -------------------------------------------------------------------
 
 # # TODO
@@ -480,20 +618,19 @@ class ViewPanel(GuiPanel):
         parent.Bind(wx.EVT_CLOSE, self.OnClose)     # EVT_CLOSE requires frame
         # Fullscreen
         self.full_frame = FullscreenFrame(
-            self, img_queue, parent.img_processes['dc'])
+            self, img_queue, parent.img_processes['dc'],
+            parent.pipeline.stats)
         self.Bind(wx.EVT_SET_FOCUS, self.OnFocus)   # HACK: doesn't work?
         # Save images
         self.img_drn = None
         # Save video
         self.vid_drn = None
-        self.vid_frame = 0
         self.vid_n = 0
         self.vid_prefix = ''
+        self.recorder = None        # FrameRecorder while recording
         # self.vid_writer = None      # cv2.VideoWriter
         # Sum images
-        self.sum_dtype = None
-        self.sum_final = None
-        self.sum_frames = []
+        self.summer = RollingSum()
         # FPS (frames per second) counter
         self.fps_time = fps_time
         self.frames = 0
@@ -505,17 +642,30 @@ class ViewPanel(GuiPanel):
 
     def _fps_loop(self):
         ''' Target process for FPS counter thread '''
-        def update(f):
+        def update(f, d='-'):
             self.fps = f
+            self.drops = d
+            recorder = self.recorder
+            if recorder:
+                stats = recorder.stats()
+                self.rec_queue = '{queued}/{dropped}'.format(**stats)
+                self.rec_rate = '{:.1f}'.format(stats['mb_per_s'])
+            else:
+                self.rec_queue = self.rec_rate = '-'
+
+        def dropped():
+            # Only LatestQueue counts frames it overwrites
+            return str(getattr(self.parent.img_queue, 'dropped', '-'))
 
         wait = self.parent.img_show.wait
         while True:
             if not self.play_btn:
-                wx.CallAfter(update, '-')
+                wx.CallAfter(update, '-', dropped())
             wait()
             f0 = self.frames
             time.sleep(self.fps_time)
-            wx.CallAfter(update, str((self.frames - f0) / self.fps_time))
+            wx.CallAfter(
+                update, str((self.frames - f0) / self.fps_time), dropped())
 
     def MakeLayout(self):
         # Make GUI elements
@@ -524,11 +674,21 @@ class ViewPanel(GuiPanel):
         full_btn = wx.ToggleButton(self, label='Full', size=SZ1)
         img_save_btn = wx.Button(self, label='Save', size=SZ1)
         vid_save_btn = wx.ToggleButton(self, label='Record', size=SZ1)
+        vid_format = wx.Choice(self, choices=('png series', 'raw video'))
+        vid_format.SetSelection(0)
         sum_btn = wx.ToggleButton(self, label='Add', size=SZ1)
         sum_n = TextCtrl(
             self, value='0', size=SZ1, style=wx.TE_PROCESS_ENTER, length=4)
+        sum_mode = wx.Choice(self, choices=RollingSum.MODES)
+        sum_mode.SetSelection(0)    # sum
         fps_lbl = wx.StaticText(self, label='FPS ')
         fps = wx.StaticText(self, label='-', size=WD1)
+        drops_lbl = wx.StaticText(self, label='Drop ')
+        drops = wx.StaticText(self, label='-', size=WD1)
+        rec_queue_lbl = wx.StaticText(self, label='Queue ')
+        rec_queue = wx.StaticText(self, label='-', size=WD1)
+        rec_rate_lbl = wx.StaticText(self, label='MB/s ')
+        rec_rate = wx.StaticText(self, label='-', size=WD1)
 
         # Bind elements to functions
         source.Bind(wx.EVT_CHOICE, self.select_source)
@@ -544,9 +704,14 @@ class ViewPanel(GuiPanel):
         self.full_btn = full_btn
         self.img_save_btn = img_save_btn
         self.vid_save_btn = vid_save_btn
+        self.vid_format = vid_format
         self.sum_btn = sum_btn
         self.sum_n = sum_n
+        self.sum_mode = sum_mode
         self.fps = fps
+        self.drops = drops
+        self.rec_queue = rec_queue
+        self.rec_rate = rec_rate
 
         # Return layout for assembly
         layout = [
@@ -556,10 +721,18 @@ class ViewPanel(GuiPanel):
             GuiItem(full_btn, (2, 1)),
             GuiItem(img_save_btn, (3, 0)),
             GuiItem(vid_save_btn, (3, 1)),
-            GuiItem(sum_btn, (4, 0)),
-            GuiItem(sum_n, (4, 1)),
-            GuiItem(fps_lbl, (5, 0), flag=ALIGN_CENTER_RIGHT),
-            GuiItem(fps, (5, 1))]
+            GuiItem(vid_format, (4, 0), SP2, wx.EXPAND),
+            GuiItem(sum_btn, (5, 0)),
+            GuiItem(sum_n, (5, 1)),
+            GuiItem(sum_mode, (6, 0), SP2, wx.EXPAND),
+            GuiItem(fps_lbl, (7, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(fps, (7, 1)),
+            GuiItem(drops_lbl, (8, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(drops, (8, 1)),
+            GuiItem(rec_queue_lbl, (9, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(rec_queue, (9, 1)),
+            GuiItem(rec_rate_lbl, (10, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(rec_rate, (10, 1))]
         return layout
 
     def OnClose(self, event):
@@ -660,6 +833,8 @@ class ViewPanel(GuiPanel):
         # Reassemble GUI
         parent.Assemble()
         self.update()
+        for hook in parent.device_hooks:
+            hook(self.device)
 
     def set_source(self, i=0):
         self.GetObject('source').SetSelection(i)
@@ -670,50 +845,22 @@ class ViewPanel(GuiPanel):
         self.sum_btn = self.validate()
 
     def sum_img(self, img):
-        ''' Rolling sum over self.sum_n frames '''
+        ''' Rolling sum, mean or max over self.sum_n frames '''
+        summer = self.summer
         if self.sum_btn:
             # Reset all if n is invalid
             sum_n = self.sum_n
             if isinstance(sum_n, str) or sum_n < 2:
                 self.sum_btn = False
-                self.sum_dtype = None
-                self.sum_final = None
-                self.sum_frames = []
-            # Init or reset saved info if format has changed
-            elif self.sum_final is None                     \
-                    or self.sum_final.shape != img.shape    \
-                    or self.sum_dtype != img.dtype:
-                self.sum_dtype = img.dtype
-                self.sum_final = img.astype(np.float64)
-                self.sum_frames = [img.copy()]
-            # Otherwise, do the thing
+                summer.reset()
+            # Otherwise, do the thing (resets itself if settings changed)
             else:
-                # Add new image to self.sum_final and self.sum_frames
-                sum_final = self.sum_final
-                sum_frames = self.sum_frames
-                sum_final += img.astype(np.float64)
-                sum_frames.append(img.copy())
-                # Subtract frames if n has changed and we have too many
-                while len(sum_frames) > sum_n:
-                    sum_final -= sum_frames.pop(0)
-                # Return as appropriate dtype
-                # If original was 8-bit, try to preserve bit depth:
-                #     - if max > 255, scale up to 65535 and return as 16-bit
-                #     - if max <= 255, don't scale, return as 8-bit
-                # If original was 16-bit, avoid overrun:
-                #     - if max > 65535, scale down to 65535, return as 16-bit
-                new_dtype = np.uint16
-                mx = sum_final.max()
-                if mx > 65535 or (img.dtype == np.uint8 and mx > 255):
-                    img = sum_final * (65535 / mx)
-                elif img.dtype == np.uint8:
-                    new_dtype = np.uint8
-                img = img.astype(new_dtype)
-        elif self.sum_dtype:
+                summer.n = int(sum_n)
+                summer.mode = RollingSum.MODES[self.sum_mode]
+                img = summer.add(img)
+        elif summer.count:
             # Clear saved frames if any remain when button isn't pressed
-            self.sum_dtype = None
-            self.sum_final = None
-            self.sum_frames = []
+            summer.reset()
         return img
 
     def fullscreen(self, event=None):
@@ -729,8 +876,10 @@ class ViewPanel(GuiPanel):
 
     def save_img(self, event=None):
         ''' Save still image via dialog '''
-        if isinstance(self.parent.image, np.ndarray):
-            img = self.parent.image.copy()
+        # Latest frame, without waiting: the pipeline may be waiting for
+        # this thread to paint
+        img = self.parent.pipeline.snapshot.get(timeout=0)
+        if isinstance(img, np.ndarray):
             ext = '.png'
             dialog = wx.FileDialog(
                 self, 'Save image', self.img_drn or '', 'image.png', '*'+ext,
@@ -750,10 +899,10 @@ class ViewPanel(GuiPanel):
         #     if not is_color(img):
         #         img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
         #     self.video_writer.write(img)
-        if self.vid_save_btn and self.vid_drn:
-            fn = self.vid_prefix + str(self.vid_frame) + '.png'
-            cv2.imwrite(fn, img, (cv2.IMWRITE_PNG_COMPRESSION, 0))
-            self.vid_frame += 1
+        recorder = self.recorder
+        if recorder:
+            # Never waits on disk. Capture time keeps the sensor's cadence.
+            recorder.record(img, self.parent.pipeline.timestamp())
         return img
 
     def save_vid(self, event=None):
@@ -762,12 +911,28 @@ class ViewPanel(GuiPanel):
         if self.play_btn and self.vid_save_btn:
             flag = self.parent.img_show
             flag.clear()            # Pause capture
-            dialog = wx.DirDialog(self, 'Save frames', self.vid_drn or '')
+            if self.vid_format:     # Raw video file
+                ext = '.raw'
+                dialog = wx.FileDialog(
+                    self, 'Save video', self.vid_drn or '', 'video' + ext,
+                    '*' + ext, wx.FD_SAVE)
+            else:                   # Series of PNG images
+                dialog = wx.DirDialog(
+                    self, 'Save frames', self.vid_drn or '')
             if dialog.ShowModal() == wx.ID_OK:
-                self.vid_drn = dialog.GetPath()
-                self.vid_frame = 1
-                self.vid_n += 1
-                self.vid_prefix = self.vid_drn + '/' + str(self.vid_n) + '_'
+                if self.vid_format:
+                    fn = dialog.GetPath()
+                    if fn[-4:].lower() != ext:
+                        fn += ext
+                    self.vid_drn = get_dir_name(fn)
+                    # Raw frames are only copied, one thread keeps order
+                    self.recorder = FrameRecorder(RawWriter(fn), threads=1)
+                else:
+                    self.vid_drn = dialog.GetPath()
+                    self.vid_n += 1
+                    self.vid_prefix = \
+                        self.vid_drn + '/' + str(self.vid_n) + '_'
+                    self.recorder = FrameRecorder(PngWriter(self.vid_prefix))
             else:
                 self.vid_save_btn = False
         #     fn = FileDialog('Save video', '.avi', save=True)
@@ -788,6 +953,9 @@ class ViewPanel(GuiPanel):
             flag.set()              # Continue capture
         else:
             self.vid_save_btn = False
+            if self.recorder:       # Queued frames finish in background
+                self.recorder.close()
+                self.recorder = None
 
 
 # Sensor templates
@@ -997,34 +1165,43 @@ class CapturePanel(TextCtrlPanel):
 # Image processing
 
 class ColorPanel(GuiPanel):
-    ''' Color processing '''
-
-    RNG8 = np.arange(0, 256)    # Pixel values for range_img
+    ''' Color processing, see processing.ColorProcessor '''
 
     def __init__(self, *args, name='Color', **kwargs):
+        self.color = ColorProcessor()
+        self.gamma = 2.2            # Last valid gamma value
+        self.hist_time = 0.2        # Seconds between histogram updates
+        self.variants_key = (1, 0)  # Colormap and split of pipeline views
+        self.hist_flag = threading.Event()  # Set while histogram is shown
+        self.closed = False         # Panel destroyed, threads should exit
         super().__init__(*args, name=name, **kwargs)
-        self.gamma_lut = None
-        self.sat_map = None
-        self.GetParent().img_processes['resized'].append(self.process_img)
+        processes = self.GetParent().img_processes
+        processes['full'].append(self.color.find_sat_full)
+        processes['resized'].append(self.process_img)
+        hist_thread = threading.Thread(target=self._hist_loop)
+        hist_thread.daemon = True
+        hist_thread.start()
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+    def OnDestroy(self, event):
+        ''' Unregister from GuiFrame and stop background threads once
+            removed (e.g. new source) '''
+        if event.GetEventObject() is self:
+            parent = self.GetParent()
+            parent.img_processes['full'].remove(self.color.find_sat_full)
+            parent.img_processes['resized'].remove(self.process_img)
+            parent.pipeline.variants = []
+            parent.pipeline.high_bit = False
+            self.closed = True
+            self.hist_flag.set()    # Wake _hist_loop so it can exit
+        event.Skip()
 
     def MakeLayout(self):
-        colormaps = (               # defined to match OpenCV indices
-            'force gray',
-            'no mapping',
-            'autumn',
-            'bone',
-            'cool',
-            'hot',
-            'HSV',
-            'jet',
-            'ocean',
-            'pink',
-            'rainbow',
-            'sping',
-            'summer',
-            'winter')
-        colormap = wx.Choice(self, choices=colormaps)
+        colormap = wx.Choice(self, choices=ColorProcessor.COLORMAPS)
         colormap.SetSelection(1)     # no colormap
+        split = wx.Choice(
+            self, choices=('no split view',) + ColorProcessor.COLORMAPS)
+        split.SetSelection(0)
         range_btn = wx.ToggleButton(self, label='Range', size=SZ2)
         range_val = TextCtrl(
             self, value='255', size=SZ1, length=3, style=wx.TE_PROCESS_ENTER)
@@ -1034,6 +1211,15 @@ class ColorPanel(GuiPanel):
         sat_btn = wx.ToggleButton(self, label='Highlight', size=SZ2)
         sat_val = TextCtrl(
             self, value='255', size=SZ1, length=3, style=wx.TE_PROCESS_ENTER)
+        sat_full_btn = wx.ToggleButton(self, label='Full-res', size=SZ2)
+        fused_btn = wx.ToggleButton(self, label='Fused LUT', size=SZ2)
+        fused_btn.SetValue(True)
+        high_bit_btn = wx.ToggleButton(self, label='16-bit LUT', size=SZ2)
+        auto_btn = wx.ToggleButton(self, label='Auto %', size=SZ2)
+        auto_val = TextCtrl(
+            self, value='0.5', size=SZ1, length=4, style=wx.TE_PROCESS_ENTER)
+        hist_btn = wx.ToggleButton(self, label='Histogram', size=SZ2)
+        hist_img = ImageWindow(self, size=SZ_THUMB)
 
         range_btn.Bind(wx.EVT_TOGGLEBUTTON, self.set_range)
         range_val.Bind(wx.EVT_TEXT_ENTER, self.set_range)
@@ -1041,31 +1227,69 @@ class ColorPanel(GuiPanel):
         gamma_val.Bind(wx.EVT_TEXT_ENTER, self.set_gamma)
         sat_btn.Bind(wx.EVT_TOGGLEBUTTON, self.set_sat)
         sat_val.Bind(wx.EVT_TEXT_ENTER, self.set_sat)
+        high_bit_btn.Bind(wx.EVT_TOGGLEBUTTON, self.set_high_bit)
+        auto_btn.Bind(wx.EVT_TOGGLEBUTTON, self.set_auto)
+        auto_val.Bind(wx.EVT_TEXT_ENTER, self.set_auto)
+        hist_btn.Bind(wx.EVT_TOGGLEBUTTON, self.set_hist)
 
         self.colormap = colormap
+        self.split = split
         self.range_btn = range_btn
         self.range_val = range_val
         self.gamma_btn = gamma_btn
         self.gamma_val = gamma_val
         self.sat_btn = sat_btn
         self.sat_val = sat_val
+        self.sat_full_btn = sat_full_btn
+        self.fused_btn = fused_btn
+        self.high_bit_btn = high_bit_btn
+        self.auto_btn = auto_btn
+        self.auto_val = auto_val
+        self.hist_btn = hist_btn
+        self.hist_img = hist_img
         self.controls.extend([
-            colormap, range_btn, range_val, gamma_btn, gamma_val, sat_btn,
-            sat_val])
+            colormap, split, range_btn, range_val, gamma_btn, gamma_val,
+            sat_btn, sat_val, sat_full_btn, fused_btn, high_bit_btn, auto_btn,
+            auto_val, hist_btn, hist_img])
 
         self.set_gamma()
 
         layout = [
             GuiItem(self.MakeLabel(), (0, 0), SP2),
             GuiItem(colormap, (1, 0), SP2, wx.EXPAND),
-            GuiItem(range_btn, (2, 0)),
-            GuiItem(range_val, (2, 1)),
-            GuiItem(gamma_btn, (3, 0)),
-            GuiItem(gamma_val, (3, 1)),
-            GuiItem(sat_btn, (4, 0)),
-            GuiItem(sat_val, (4, 1))]
+            GuiItem(split, (2, 0), SP2, wx.EXPAND),
+            GuiItem(range_btn, (3, 0)),
+            GuiItem(range_val, (3, 1)),
+            GuiItem(gamma_btn, (4, 0)),
+            GuiItem(gamma_val, (4, 1)),
+            GuiItem(sat_btn, (5, 0)),
+            GuiItem(sat_val, (5, 1)),
+            GuiItem(sat_full_btn, (6, 0), SP2, wx.EXPAND),
+            GuiItem(fused_btn, (7, 0), SP2, wx.EXPAND),
+            GuiItem(high_bit_btn, (8, 0), SP2, wx.EXPAND),
+            GuiItem(auto_btn, (9, 0)),
+            GuiItem(auto_val, (9, 1)),
+            GuiItem(hist_btn, (10, 0), SP2, wx.EXPAND),
+            GuiItem(hist_img, (11, 0), SP2, wx.ALIGN_CENTER)]
         return layout
 
+    def _hist_loop(self):
+        ''' Target process for live histogram display thread '''
+        def update(image):
+            if not self.closed and self.hist_flag.is_set():
+                self.hist_img.image = image
+                self.hist_img.Refresh()
+
+        wait = self.hist_flag.wait
+        while True:
+            wait()
+            time.sleep(self.hist_time)
+            if self.closed:
+                break
+            hist = self.color.histogram.hist
+            if hist is not None:
+                wx.CallAfter(update, histogram_image(hist, tuple(SZ_THUMB)))
+
     def set_range(self, event=None):
         ''' Validate dynamic range value '''
         if self.range_btn:
@@ -1084,8 +1308,8 @@ class ColorPanel(GuiPanel):
             except ValueError:
                 gamma = 2.2
             # Create look-up table (LUT)
-            self.gamma_lut = (np.arange(0, 1, 1/256) ** (1/gamma) * 255 + 0.5
-                              ).astype(np.uint8)
+            self.color.set_gamma(gamma)
+            self.gamma = gamma
             # Update displayed value
             self.gamma_val = gamma
 
@@ -1098,110 +1322,245 @@ class ColorPanel(GuiPanel):
                 v = 255
             self.sat_val = v
 
-    def is_sat(self):
-        ''' Check if saturated pixel highlighting is active and ready '''
-        return self.sat_btn and isinstance(self.sat_map, np.ndarray)
-
-    def colormap_img(self, img):
-        ''' Apply selected colormap by index '''
-        colormap = self.colormap - 2
-        if colormap > -1:                           # Colormap
-            img = cv2.applyColorMap(img, colormap)
-        elif colormap == -2 and is_color(img):      # Force gray
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        return img
-
-    def range_img(self, img):
-        ''' Stretch dynamic range to be from 0 to self.range_val '''
-        if self.range_btn:
-            img -= img.min()
-            if self.is_sat():
-                mx = img[~self.sat_map].max()       # Ignore saturated pixels
-            else:
-                mx = img.max()
-            if mx:
-                img = cv2.LUT(
-                    img, (self.RNG8 * self.range_val / mx).astype(np.uint8))
-        return img
-
-    def gamma_img(self, img):
-        ''' Apply gamma curve using lookup table '''
-        if self.gamma_btn:
-            img = cv2.LUT(img, self.gamma_lut)
-        return img
-
-    def find_sat_img(self, img):
-        ''' Find and save locations of pixels above given threshold '''
-        if self.sat_btn:
-            self.sat_map = img >= self.sat_val
-            if is_color(img):
-                self.sat_map = np.logical_or.reduce(self.sat_map, 2)
-        return img
+    def reset(self, event=None):
+        ''' Reset controls, leaving the fused LUT on (its default) '''
+        super().reset()
+        self.fused_btn = True
 
-    def apply_sat_img(self, img):
-        ''' Make previously-saved pixels red '''
-        if self.is_sat():
-            if not is_color(img):
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-            img[self.sat_map] = RED_PX
-        return img
+    def set_auto(self, event=None):
+        ''' Validate auto-contrast clip percentage (range must be on too) '''
+        if self.auto_btn:
+            try:
+                v = float(np.clip(float(self.auto_val), 0, 49))
+            except ValueError:
+                v = 0.5
+            self.auto_val = v
+            self.range_btn = True
+
+    def set_hist(self, event=None):
+        ''' Start or stop histogram display, clearing it when turned off '''
+        if self.hist_btn:
+            self.hist_flag.set()
+        else:
+            self.hist_flag.clear()
+            self.hist_img.image = None
+            self.hist_img.Refresh()
+
+    def set_high_bit(self, event=None):
+        ''' Pass 16-bit images to process_img without dropping the low byte,
+            so range and gamma see all bits (one 65536-entry LUT pass) '''
+        self.GetParent().pipeline.high_bit = bool(self.high_bit_btn)
+
+    def set_variants(self, colormap, split):
+        ''' Show colormap and split colormap side by side (split > 0), each
+            applied by the pipeline to the same uncolored image '''
+        if (colormap, split) != self.variants_key:
+            self.variants_key = (colormap, split)
+            self.GetParent().pipeline.variants = [
+                colormap_variant(colormap),
+                colormap_variant(split - 1)] if split else []
 
     def process_img(self, img):
-        ''' Run all image processes from this panel in order '''
-        processes = (
-            self.find_sat_img,
-            self.range_img,
-            self.gamma_img,
-            self.colormap_img,
-            self.apply_sat_img)
-        for process in processes:
-            img = process(img)
-        return img
+        ''' Update ColorProcessor settings from GUI, then run it '''
+        color = self.color
+        colormap, split = self.colormap, self.split
+        self.set_variants(colormap, split)
+        color.colormap = 1 if split else colormap   # Variants map colors
+        color.range_val = self.range_val if self.range_btn else None
+        color.set_gamma(self.gamma if self.gamma_btn else None)
+        color.sat_val = self.sat_val if self.sat_btn else None
+        color.sat_full = bool(self.sat_full_btn)
+        color.fused = bool(self.fused_btn)
+        color.auto_clip = self.auto_val if self.auto_btn else None
+        color.show_histogram = bool(self.hist_btn)
+        return color.process_img(img)
 
 
 class FlatFieldPanel(GuiPanel):
     ''' Flat field controls '''
 
-    def __init__(self, *args, name='Flat field', **kwargs):
-        self.ff = None      # Flat frame
+    def __init__(self, *args, name='Flat field',
+                 calibration_dir=CALIBRATION_DIR, **kwargs):
+        self.flat = FlatField()
+        self.store = CalibrationStore(calibration_dir)
+        self.sensor = 'unknown'     # sensor_id of current device
+        self.device = None
+        self.calibrations = {}      # (shape, dtype, roi): (FlatField, thumb)
+        self.capturing = False      # Averaging thread running
+        self.raw_frames = None      # Queue of raw frames while capturing
         super().__init__(*args, name=name, **kwargs)
         # Always do flat-frame first!
-        self.GetParent().img_processes['full'].insert(0, self.process_img)
+        parent = self.GetParent()
+        parent.img_processes['full'].insert(0, self.process_img)
+        parent.device_hooks.append(self.load)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+    def OnDestroy(self, event):
+        ''' Unregister from GuiFrame once removed (e.g. new source) '''
+        if event.GetEventObject() is self:
+            parent = self.GetParent()
+            parent.device_hooks.remove(self.load)
+            parent.img_processes['full'].remove(self.process_img)
+        event.Skip()
 
     def MakeLayout(self):
         SZ_FF = wx.Size(2.5*PX_PAD, PX_PAD)
         thumb = ImageWindow(self, size=SZ_THUMB)
-        save = wx.Button(self, label='Save', size=SZ_FF)
+        save = wx.Button(self, label='Dark', size=SZ_FF)
+        save_flat = wx.Button(self, label='Flat', size=SZ_FF)
+        avg_n = TextCtrl(
+            self, value='16', size=SZ_FF, length=4, style=wx.TE_PROCESS_ENTER)
         apply = wx.ToggleButton(self, label='Apply', size=SZ_FF)
+        mode = wx.Choice(self, choices=FlatField.MODES)
+        mode.SetSelection(0)
 
         save.Bind(wx.EVT_BUTTON, self.save)
+        save_flat.Bind(wx.EVT_BUTTON, self.save_flat)
         apply.Bind(wx.EVT_TOGGLEBUTTON, self.validate)
+        mode.Bind(wx.EVT_CHOICE, self.validate)
 
         self.save = save
+        self.save_flat = save_flat
+        self.avg_n = avg_n
         self.apply = apply
+        self.mode = mode
         self.thumb = thumb
-        self.controls.extend([save, apply, thumb])
+        self.controls.extend([save, save_flat, avg_n, apply, mode, thumb])
 
         layout = [
             GuiItem(self.MakeLabel(), (0, 0), SP2),
             GuiItem(thumb, (1, 0), SP2, wx.ALIGN_CENTER),
             GuiItem(save, (2, 0)),
-            GuiItem(apply, (2, 1))]
+            GuiItem(save_flat, (2, 1)),
+            GuiItem(avg_n, (3, 0)),
+            GuiItem(apply, (3, 1)),
+            GuiItem(mode, (4, 0), SP2, wx.EXPAND)]
         return layout
 
     def save(self, event=None):
-        ''' Update flat field and thumbnail '''
-        # Save copy of camera image
-        ff = self.GetParent().image.copy()
-        self.ff = ff
-        # Convert to 8-bit for thumbnail display
-        if ff.dtype == np.uint16:
-            ff = (ff.copy() >> 8).astype(np.uint8)
-        # Resize to thumbnail window and convert to RGB
-        self.thumb.image = to_rgb(cv2.resize(ff, tuple(SZ_THUMB)))
-        # Display thumbnail
+        ''' Average frames into the dark frame (subtracted) '''
+        self.capture('set_dark')
+
+    def save_flat(self, event=None):
+        ''' Average frames into the flat frame (gain map, divide mode) '''
+        self.capture('set_flat')
+
+    def capture(self, setter):
+        ''' Average frames on a background thread, then pass to FlatField
+            method setter '''
+        if self.capturing:
+            return
+        try:
+            n = max(1, int(self.avg_n))
+        except (TypeError, ValueError):
+            n = 1
+        self.avg_n = n
+        self.capturing = True
+        self.raw_frames = queue.Queue(n)
+        self.save.Disable()
+        self.save_flat.Disable()
+        capture_thread = threading.Thread(
+            target=self._capture_loop, args=(setter, n))
+        capture_thread.daemon = True
+        capture_thread.start()
+
+    def _new_frames(self, frames):
+        ''' Yield raw frames queued by process_img, until none arrives (e.g.
+            while paused) or the frame format changes '''
+        first = None
+        while True:
+            try:
+                img = frames.get(timeout=1.)
+            except queue.Empty:
+                return
+            if first is None:
+                first = img
+            elif img.shape != first.shape or img.dtype != first.dtype:
+                return
+            yield img
+
+    def _capture_loop(self, setter, n):
+        ''' Target process for frame averaging thread '''
+        try:
+            img, dtype = average_frames(self._new_frames(self.raw_frames), n)
+        except ValueError as e:
+            print('Error: {}, is the sensor playing?'.format(e))
+        else:
+            wx.CallAfter(self.set_frame, setter, img, dtype)
+        finally:
+            self.raw_frames = None
+            wx.CallAfter(self.end_capture)
+
+    def end_capture(self):
+        ''' Allow the next capture '''
+        self.capturing = False
+        self.save.Enable()
+        self.save_flat.Enable()
+
+    def set_frame(self, setter, img, dtype):
+        ''' Update flat field and thumbnail, and save them '''
+        roi = self.device_roi()
+        key = (img.shape, np.dtype(dtype), roi)
+        saved = self.calibrations.get(key)
+        if saved is not None:
+            # Add to the saved calibration of this format and ROI
+            flat = saved[0]
+            flat.mode = self.flat.mode
+        elif any(f is self.flat for f, _ in self.calibrations.values()):
+            # Current one is saved for another format or ROI, keep it as is
+            flat = FlatField(mode=self.flat.mode)
+        else:
+            flat = self.flat    # Not saved yet, so still empty
+        self.flat = flat
+        getattr(flat, setter)(img, dtype)
+        # Resize to thumbnail window, stretch to 8-bit and convert to RGB
+        # (stretching keeps dim 12-bit frames visible, unlike dropping bits)
+        thumb = cv2.resize(
+            img, tuple(SZ_THUMB), interpolation=cv2.INTER_AREA)
+        thumb = to_rgb(
+            cv2.normalize(thumb, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U))
+        self.show_thumb(thumb)
+        # Save for next time this sensor, format and ROI are used
+        self.calibrations[key] = (flat, thumb)
+        self.store.save(
+            self.sensor, img.shape, dtype, dict(flat.frames(), thumb=thumb),
+            roi)
+
+    def show_thumb(self, thumb):
+        self.thumb.image = thumb
         self.thumb.Refresh()
 
+    def device_roi(self):
+        ''' Return sensor region of the current device, as fractions of the
+            full frame (see RoiPanel), or None for the full frame. Read when
+            needed, as the ROI can change while the device is selected. '''
+        get_roi = getattr(self.device, 'roi', None)
+        roi = get_roi(None) if callable(get_roi) else None
+        if roi and tuple(roi) != (0, 0, 1, 1):
+            return tuple(float(n) for n in roi)
+        return None
+
+    def load(self, device):
+        ''' Memory-map saved calibrations of a newly selected sensor. Each is
+            used once frames of its format and ROI arrive. '''
+        self.sensor = getattr(device, 'sensor_id', type(device).__name__)
+        self.device = device
+        mode = self.flat.mode
+        calibrations = {}
+        saved = self.store.load_sensor(self.sensor)
+        for key, frames in saved.items():
+            flat = FlatField(mode=mode)
+            flat.set_frames(
+                key[1], frames.get('ff'), frames.get('flat'),
+                frames.get('gain'))
+            thumb = frames.get('thumb')
+            if thumb is not None:
+                thumb = np.array(thumb)     # Small, wx needs a buffer
+            calibrations[key] = (flat, thumb)
+        self.calibrations = calibrations
+        self.flat = FlatField(mode=mode)
+        self.show_thumb(None)
+
     def reset(self, event=None):
         self.apply = False
         self.thumb.image = None
@@ -1209,21 +1568,42 @@ class FlatFieldPanel(GuiPanel):
 
     def validate(self, event=None):
         ret = True
-        if self.ff is None:
+        self.flat.mode = FlatField.MODES[self.mode]
+        if self.flat.ff is None and self.flat.gain is None \
+                and not self.calibrations:
             self.reset()
             ret = False
         return ret
 
     def flatfield_img(self, img):
         if self.apply:
-            # Cancel if image size or color depth has changed
-            if self.ff.shape != img.shape or self.ff.dtype is not img.dtype:
-                self.reset()
-            else:
-                img = cv2.subtract(img, self.ff)    # clips between 0-255
+            flat = self.flat
+            if not flat.matches(img):
+                # Switch to saved calibration for this format and ROI, if any
+                saved = self.calibrations.get(
+                    (img.shape, img.dtype, self.device_roi()))
+                if saved is not None and saved[0] is not flat:
+                    saved[0].mode = flat.mode
+                    flat = self.flat = saved[0]
+                    wx.CallAfter(self.show_thumb, saved[1])
+            # Skip frames of another size or color depth (e.g. while the
+            # source changes) but keep the frames for when it changes back
+            if flat.matches(img):
+                img = flat.flatfield_img(img)
         return img
 
+    def capture_img(self, img):
+        ''' Queue a copy of the raw frame for averaging, before correction
+            and summing (dark and flat frames must be uncorrected) '''
+        frames = self.raw_frames
+        if frames is not None:
+            try:
+                frames.put_nowait(img.copy())
+            except queue.Full:
+                pass
+
     def process_img(self, img):
+        self.capture_img(img)
         return self.flatfield_img(img)
 
 
@@ -1231,14 +1611,41 @@ class FringePanel(GuiPanel):
     ''' Controls related to interference fringes '''
 
     def __init__(self, *args, name='Fringes', **kwargs):
+        self.analysis_size = (256, 256)     # (w, h), see decimate_roi
+        self.roi = None             # (x0, y0, x1, y1) fractions, None = all
+        self.history = FringeHistory()
+        self.results = queue.SimpleQueue()  # From workers to self.history
+        self.update_time = 0.5      # Seconds between display updates
+        self.stats_time = 10.       # Seconds of results in mean and std
+        self.chart_time = 60.       # Seconds of results in strip chart
+        self.csv_drn = None
+        self.analysis_rate = 10.    # Frames per second analyzed, 0 = all
+        self.chart_column = 1       # History column shown in strip chart
+        self.closed = False         # Panel destroyed, threads should exit
         super().__init__(*args, name=name, **kwargs)
-        self.GetParent().img_processes['resized'].append(self.process_img)
-        self.dc_mask = 2    # pixels
-        self.fringe_data = []
+        processes = self.GetParent().img_processes
+        processes['full'].append(self.fringe_img)
+        processes['resized'].append(self.process_img)
+        self.analyzer = FringeEstimator()
+        self.analysis = AnalysisPool(
+            self.analyzer.analyze, self.add_result, rate=self.analysis_rate)
         self.fringe_flag = threading.Event()
         fringe_thread = threading.Thread(target=self._fringe_loop)
         fringe_thread.daemon = True
         fringe_thread.start()
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+    def OnDestroy(self, event):
+        ''' Unregister from GuiFrame and stop analysis threads once removed
+            (e.g. new source) '''
+        if event.GetEventObject() is self:
+            processes = self.GetParent().img_processes
+            processes['full'].remove(self.fringe_img)
+            processes['resized'].remove(self.process_img)
+            self.analysis.close()
+            self.closed = True
+            self.fringe_flag.set()  # Wake _fringe_loop so it can exit
+        event.Skip()
 
     def MakeLayout(self):
         draw_n = TextCtrl(
@@ -1247,21 +1654,61 @@ class FringePanel(GuiPanel):
         fringe_btn = wx.ToggleButton(self, label='Analyze', size=SZ2)
         fringe_count_lbl = wx.StaticText(self, label='Count')
         fringe_count = wx.StaticText(self, label='-')
+        fringe_count_std = wx.StaticText(self, label='-')
         fringe_tilt_lbl = wx.StaticText(self, label='Tilt')
         fringe_tilt = wx.StaticText(self, label='-')
+        fringe_tilt_std = wx.StaticText(self, label='-')
         fringe_contrast_lbl = wx.StaticText(self, label='Contrast')
         fringe_contrast = wx.StaticText(self, label='-')
+        fringe_contrast_std = wx.StaticText(self, label='-')
+        rate_lbl = wx.StaticText(self, label='Rate')
+        rate = TextCtrl(
+            self, value=str(self.analysis_rate), size=SZ1, length=4,
+            style=wx.TE_PROCESS_ENTER)
+        roi_lbl = wx.StaticText(self, label='ROI')
+        roi_reset_btn = wx.Button(self, label='Reset', size=SZ1)
+        x_lbl = wx.StaticText(self, label='x')
+        x0 = TextCtrl(self, size=SZ1, length=6, style=wx.TE_PROCESS_ENTER)
+        x1 = TextCtrl(self, size=SZ1, length=6, style=wx.TE_PROCESS_ENTER)
+        y_lbl = wx.StaticText(self, label='y')
+        y0 = TextCtrl(self, size=SZ1, length=6, style=wx.TE_PROCESS_ENTER)
+        y1 = TextCtrl(self, size=SZ1, length=6, style=wx.TE_PROCESS_ENTER)
+        chart = wx.Choice(self, choices=FringeHistory.COLUMNS[1:])
+        chart.SetSelection(0)
+        csv_btn = wx.Button(self, label='Save', size=SZ1)
+        chart_img = ImageWindow(self, size=SZ_THUMB)
 
         draw_n.Bind(wx.EVT_TEXT_ENTER, self.draw_start)
         fringe_btn.Bind(wx.EVT_TOGGLEBUTTON, self.fringe_start)
+        rate.Bind(wx.EVT_TEXT_ENTER, self.set_rate)
+        roi_reset_btn.Bind(wx.EVT_BUTTON, self.reset_roi)
+        for ctrl in (x0, x1, y0, y1):
+            ctrl.Bind(wx.EVT_TEXT_ENTER, self.set_roi)
+        csv_btn.Bind(wx.EVT_BUTTON, self.save_csv)
+        chart.Bind(wx.EVT_CHOICE, self.set_chart)
 
         self.draw_n = draw_n
         self.draw_btn = draw_btn
         self.fringe_btn = fringe_btn
         self.fringe_count = fringe_count
+        self.fringe_count_std = fringe_count_std
         self.fringe_tilt = fringe_tilt
+        self.fringe_tilt_std = fringe_tilt_std
         self.fringe_contrast = fringe_contrast
-        self.controls.extend([draw_n, draw_btn, fringe_btn])
+        self.fringe_contrast_std = fringe_contrast_std
+        self.rate = rate
+        self.x0 = x0
+        self.x1 = x1
+        self.y0 = y0
+        self.y1 = y1
+        self.chart = chart
+        self.chart_img = chart_img
+        # Not rate and ROI, which keep their values when reset() clears the
+        # others
+        self.controls.extend([
+            draw_n, draw_btn, fringe_btn, roi_reset_btn, chart, csv_btn,
+            chart_img])
+        self.reset_roi()
 
         layout = [
             GuiItem(self.MakeLabel(), (0, 0), SP2),
@@ -1270,15 +1717,79 @@ class FringePanel(GuiPanel):
             GuiItem(fringe_btn, (2, 0), SP2, flag=wx.EXPAND),
             GuiItem(fringe_count_lbl, (3, 0), flag=wx.ALIGN_RIGHT),
             GuiItem(fringe_count, (3, 1)),
+            GuiItem(fringe_count_std, (3, 2)),
             GuiItem(fringe_tilt_lbl, (4, 0), flag=wx.ALIGN_RIGHT),
             GuiItem(fringe_tilt, (4, 1)),
+            GuiItem(fringe_tilt_std, (4, 2)),
             GuiItem(fringe_contrast_lbl, (5, 0), flag=wx.ALIGN_RIGHT),
-            GuiItem(fringe_contrast, (5, 1))]
+            GuiItem(fringe_contrast, (5, 1)),
+            GuiItem(fringe_contrast_std, (5, 2)),
+            GuiItem(rate_lbl, (6, 0), flag=wx.ALIGN_RIGHT),
+            GuiItem(rate, (6, 1)),
+            GuiItem(roi_lbl, (7, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(roi_reset_btn, (7, 1)),
+            GuiItem(x_lbl, (8, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(x0, (8, 1)),
+            GuiItem(x1, (8, 2)),
+            GuiItem(y_lbl, (9, 0), flag=ALIGN_CENTER_RIGHT),
+            GuiItem(y0, (9, 1)),
+            GuiItem(y1, (9, 2)),
+            GuiItem(chart, (10, 0), SP2, flag=wx.EXPAND),
+            GuiItem(csv_btn, (10, 2)),
+            GuiItem(chart_img, (11, 0), SP3, wx.ALIGN_CENTER)]
         return layout
 
     def draw_start(self, event=None):
         self.draw_btn = True
 
+    def set_rate(self, event=None):
+        ''' Validate analysis rate (frames per second, 0 = every frame) '''
+        try:
+            v = max(0., float(self.rate))
+        except ValueError:
+            v = self.analysis_rate
+        self.rate = v
+        self.analysis_rate = self.analysis.rate = v
+
+    def set_roi(self, event=None):
+        ''' Validate analysis region, start and end fractions of the frame '''
+        try:
+            x0, y0 = np.clip((float(self.x0), float(self.y0)), 0, 1)
+            x1, y1 = np.clip((float(self.x1), float(self.y1)), 0, 1)
+        except ValueError:
+            x0, y0, x1, y1 = self.roi or (0., 0., 1., 1.)   # Keep last
+        x1, y1 = max(x0, x1), max(y0, y1)
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+        roi = (x0, y0, x1, y1)
+        self.roi = None if roi == (0, 0, 1, 1) else roi
+
+    def reset_roi(self, event=None):
+        self.x0 = self.y0 = 0.
+        self.x1 = self.y1 = 1.
+        self.set_roi()
+
+    def add_result(self, result, timestamp):
+        ''' Collect (count, contrast, tilt) from the analysis workers, to be
+            stored by _fringe_loop, the single writer of self.history '''
+        self.results.put((timestamp,) + tuple(result))
+
+    def save_csv(self, event=None):
+        ''' Save stored fringe results via dialog '''
+        ext = '.csv'
+        dialog = wx.FileDialog(
+            self, 'Save fringe results', self.csv_drn or '', 'fringes' + ext,
+            '*' + ext, wx.FD_SAVE)
+        if dialog.ShowModal() == wx.ID_OK:
+            fn = dialog.GetPath()
+            if fn[-4:].lower() != ext:
+                fn += ext
+            self.history.save_csv(fn)
+            self.csv_drn = get_dir_name(fn)
+
+    def set_chart(self, event=None):
+        ''' Select quantity for the strip chart (read by _fringe_loop) '''
+        self.chart_column = self.chart + 1
+
     def fringe_start(self, event=None):
         if self.fringe_btn:
             self.fringe_flag.set()
@@ -1293,84 +1804,65 @@ class FringePanel(GuiPanel):
         return ret
 
     def _fringe_loop(self):
+        ''' Target process storing results and showing rolling statistics
+            and strip chart, the only thread writing to self.history '''
         def pretty(n):
             return str(n)[:6]
 
-        def update(count='-', contrast='-', tilt='-'):
-            self.fringe_count = pretty(count)
-            self.fringe_tilt = pretty(tilt)
-            self.fringe_contrast = pretty(contrast)
-
+        def update(stats=None, chart=None):
+            if self.closed:
+                return
+            mean, std = stats if stats else (('-',) * 3,) * 2
+            (self.fringe_count, self.fringe_contrast,
+             self.fringe_tilt) = map(pretty, mean)
+            (self.fringe_count_std, self.fringe_contrast_std,
+             self.fringe_tilt_std) = map(pretty, std)
+            self.chart_img.image = chart
+            self.chart_img.Refresh()
+
+        history = self.history
+        get = self.results.get_nowait
         wait = self.fringe_flag.wait
         while True:
-            count = contrast = tilt = 0
-            if not self.fringe_btn:
+            if not self.fringe_flag.is_set():
                 wx.CallAfter(update)
             wait()
-            time.sleep(1.)
-            for n, c, t in self.fringe_data:
-                count += n
-                contrast += c
-                tilt += t
-            if count:
-                c = len(self.fringe_data)
-                wx.CallAfter(update, count/c, contrast/c, tilt/c)
-                self.fringe_data = []
+            time.sleep(self.update_time)
+            if self.closed:
+                break
+            while True:
+                try:
+                    history.add(get())
+                except queue.Empty:
+                    break
+            rows = history.rows(self.chart_time)
+            if len(rows):
+                chart = strip_chart(
+                    rows[:, 0], rows[:, self.chart_column], tuple(SZ_THUMB),
+                    self.chart_time)
+                wx.CallAfter(update, history.stats(self.stats_time), chart)
 
     def fringe_img(self, img):
-        if self.fringe_btn:
-            # TODO: color images
-            if is_color(img):
-                self.fringe_btn = False
-            else:
-                # Smoothing
-                img2 = cv2.GaussianBlur(img, (0, 0), 3)
-
-                # Fringe contrast
-                h, w = img2.shape
-                x, y, r = int(w/2), int(h/2), int(w/5)
-                chunk = img2[x-r:x+r, y-r:y+r]
-                contrast = (chunk.max() - chunk.min()) / 255
-
-                # Fringe count / tilt
-                # DFT
-                fft = np.fft.fftshift(np.abs(np.fft.rfft2(img2)))
-                # DC mask
-                h, w = fft.shape
-                x_c, y_c, dc = int(w/2), int(h/2), self.dc_mask
-                fft[y_c-dc:y_c+dc, x_c-dc:x_c+dc] = 0
-                # Find peak
-                y_max, x_max = np.unravel_index(fft.argmax(), fft.shape)
-                x_dist, y_dist = x_max - x_c, y_max - y_c
-                # Count
-                n = np.sqrt(x_dist*x_dist + y_dist*y_dist)
-                # Tilt
-                tilt = np.degrees(y_dist/x_dist + np.pi) if x_dist else 90.0
-
-                # Save results
-                self.fringe_data.append((n, contrast, tilt))
+        ''' Hand a decimated copy of the full-resolution ROI to the analysis
+            workers if due, so results don't depend on the display size '''
+        if self.fringe_btn and self.analysis.due():
+            self.analysis.submit(
+                decimate_roi(img, self.roi, self.analysis_size),
+                self.GetParent().pipeline.timestamp())
         return img
 
     def draw_img(self, img):
         if self.draw_btn:
             n = self.draw_n
             if isinstance(n, float):
-                h, w = img.shape[:2]
-                col = int(w/2)
-                row = d = int(h/(n+1) + 0.5)
-                px = GREEN_PX if is_color(img) else 255
-                for i in range(int(n)):
-                    img[row, :col] = px
-                    row += d
+                img = draw_lines(img, n)
             else:
                 self.draw_btn = False
                 self.draw_n = ''
         return img
 
     def process_img(self, img):
-        for process in (self.draw_img, self.fringe_img):
-            img = process(img)
-        return img
+        return self.draw_img(img)
 
 
 class TargetPanel(GuiPanel):
@@ -1490,6 +1982,85 @@ class TargetPanel(GuiPanel):
         return self.target_img(img)
 
 
+# Diagnostics
+
+class StatsPanel(GuiPanel):
+    ''' Pipeline timing readout (p50/p95/p99 per stage and process), with
+        CSV/JSON export '''
+
+    def __init__(self, parent, stats, name='Stats', update_time=1, **kwargs):
+        self.stats = stats
+        self.update_time = update_time
+        self.stats_drn = None
+        super().__init__(parent, name=name, **kwargs)
+        stats_thread = threading.Thread(target=self._stats_loop)
+        stats_thread.daemon = True
+        stats_thread.start()
+
+    def MakeLayout(self):
+        table = wx.TextCtrl(
+            self, size=wx.Size(14*PX_PAD, 10*PX_PAD),
+            style=wx.TE_MULTILINE | wx.TE_READONLY | wx.TE_DONTWRAP)
+        table.SetFont(wx.Font(
+            8, wx.FONTFAMILY_TELETYPE, wx.FONTSTYLE_NORMAL,
+            wx.FONTWEIGHT_NORMAL))
+        export_btn = wx.Button(self, label='Export', size=SZ2)
+        reset_btn = wx.Button(self, label='Reset', size=SZ2)
+
+        export_btn.Bind(wx.EVT_BUTTON, self.export)
+        reset_btn.Bind(wx.EVT_BUTTON, self.reset_stats)
+
+        self.table = table
+        self.export_btn = export_btn
+        self.reset_btn = reset_btn
+
+        layout = [
+            GuiItem(self.MakeLabel(), (0, 0), SP2),
+            GuiItem(table, (1, 0), SP2, wx.EXPAND),
+            GuiItem(export_btn, (2, 0)),
+            GuiItem(reset_btn, (2, 1))]
+        return layout
+
+    def _stats_loop(self):
+        ''' Target process for stats readout thread '''
+        while True:
+            time.sleep(self.update_time)
+            if self.IsShownOnScreen():
+                wx.CallAfter(self.update_table, self.stats.summary())
+
+    def update_table(self, summary):
+        ''' Format summary from PipelineStats as a fixed-width table '''
+        row = '{:<24.24}{:>7.2f}{:>7.2f}{:>7.2f}{:>7.2f}'.format
+        lines = ['{:<24}{:>7}{:>7}{:>7}{:>7}'.format(
+            'ms', 'p50', 'p95', 'p99', 'max')]
+        for name, t in summary['timers'].items():
+            if t['count']:
+                lines.append(row(
+                    name, t['p50_ms'], t['p95_ms'], t['p99_ms'], t['max_ms']))
+        for name, count in summary['counters'].items():
+            lines.append('{:<24.24}{:>7}'.format(name, count))
+        self.table = '\n'.join(lines)
+
+    def export(self, event=None):
+        ''' Save current statistics as .csv or .json via dialog '''
+        dialog = wx.FileDialog(
+            self, 'Export statistics', self.stats_drn or '', 'stats.csv',
+            'CSV (*.csv)|*.csv|JSON (*.json)|*.json', wx.FD_SAVE)
+        if dialog.ShowModal() == wx.ID_OK:
+            fn = dialog.GetPath()
+            if fn[-5:].lower() == '.json':
+                self.stats.to_json(fn)
+            else:
+                if fn[-4:].lower() != '.csv':
+                    fn += '.csv'
+                self.stats.to_csv(fn)
+            self.stats_drn = get_dir_name(fn)
+
+    def reset_stats(self, event=None):
+        self.stats.reset()
+        self.table = ''
+
+
 # wx.Window ------------------------------------------------------------------
 
 class ImageWindow(wx.Window):
@@ -1511,28 +2082,41 @@ class ImageWindow(wx.Window):
 
 
 class VideoWindow(ImageWindow):
-    ''' Subclass of ImageWindow for rapidly painting images '''
+    ''' Subclass of ImageWindow for rapidly painting images.
+        img_queue: queue of Frames holding RGB images
+        stats: optional PipelineStats to time painting and dc_processes '''
 
     def __init__(self, parent, img_queue, dc_processes=[], size=SZ_IMAGE,
-                 **kwargs):
+                 stats=None, **kwargs):
         super().__init__(parent, size=size, **kwargs)
         self.dc_processes = dc_processes
         self.img_queue = img_queue
+        self.stats = stats or PipelineStats()
 
     def OnPaint(self, event):
-        ''' Get image from queue and draw '''
+        ''' Get Frame from queue and draw, tracking latency since capture '''
         try:
-            img = self.img_queue.get(timeout=0.5)
+            frame = self.img_queue.get(timeout=0.5)
         except queue.Empty:
             return
+        img = frame.img
         # Skip frame if not resized properly (window recently changed size)
         size = self.GetSize()
         if size == img.shape[:2][::-1]:     # Reverse (h, w) from numpy to wx
+            add = self.stats.add
+            clock = time.perf_counter
             # Draw image and update
+            t0 = clock()
             dc = wx.PaintDC(self)
             dc.DrawBitmap(wx.Bitmap.FromBuffer(*size, img), 0, 0)
+            t1 = clock()
+            add('stage: paint', t1 - t0)
             for process in self.dc_processes:
                 process(dc)
+                t0, t1 = t1, clock()
+                add('dc: ' + process_name(process), t1 - t0)
+            self.stats.frame_done(frame)
+        # img goes back to its BufferPool once this reference is dropped
 
 
 # wx.Frame -------------------------------------------------------------------
@@ -1540,10 +2124,12 @@ class VideoWindow(ImageWindow):
 class FullscreenFrame(wx.Frame):
     ''' Frame that simulates fullscreen on Show() '''
 
-    def __init__(self, parent, img_queue, dc_processes=[], style=0, **kwargs):
+    def __init__(self, parent, img_queue, dc_processes=[], stats=None,
+                 style=0, **kwargs):
         super().__init__(parent, style=style, **kwargs)
         # Image display
-        self.img_window = VideoWindow(self, img_queue, dc_processes)
+        self.img_window = VideoWindow(
+            self, img_queue, dc_processes, stats=stats)
         self.img_window.Bind(wx.EVT_KEY_DOWN, self.OnKey)
 
     def OnKey(self, event):
@@ -1564,69 +2150,98 @@ class FullscreenFrame(wx.Frame):
 
 class GuiFrame(wx.Frame):
     ''' Simple three-section GUI with image, left sidebar, and bottom bar.
-        Many functions are tightly integrated with ViewPanel. '''
+        Many functions are tightly integrated with ViewPanel.
+        pipelined: run each pipeline stage on its own thread
+        depth: queue depth between pipeline stages (pipelined only)
+        latest: sensors overwrite unprocessed frames instead of waiting '''
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, pipelined=False, depth=1, latest=False,
+                 **kwargs):
         super().__init__(*args, **kwargs)
         # Image control
         self.img_show = threading.Event()
-        self.img_queue = queue.Queue(1)
+        self.img_queue = LatestQueue(1) if latest else queue.Queue(1)
         self.img_processes = {
             'full': [],
             'resized': [],
             'dc': []}
+        self.device_hooks = []      # Called with each newly selected sensor
         self.display_queue = queue.Queue(1)
+        if pipelined:
+            self.pipeline = ThreadedPipeline(
+                self.img_queue, self.show_img, self.img_processes,
+                self.display_size, depth, self.img_show)
+        else:
+            self.pipeline = Pipeline(self.img_processes, self.display_size)
+        self.pipeline.snapshot.image = np.zeros(SZ_IMAGE, dtype=np.uint8)
         # GUI elements
-        self.image = np.zeros(SZ_IMAGE, dtype=np.uint8)
+        stats = self.pipeline.stats
         self.img_window = VideoWindow(
-            self, self.display_queue, self.img_processes['dc'])
+            self, self.display_queue, self.img_processes['dc'], stats=stats)
         self.view_panel = ViewPanel(self, self.display_queue)
+        self.stats_panel = StatsPanel(self, stats)
+        stats.counters.update({
+            'frames: shown': lambda: self.view_panel.frames,
+            'dropped: img_queue': lambda: getattr(
+                self.img_queue, 'dropped', 0),
+            'dropped: recorder': lambda: getattr(
+                self.view_panel.recorder, 'dropped', 0)})
         # TODO: Panel requests
         # self.panel_requests = {'sensor': 'all', 'stage': 'all'}
         self.layout = {
-            'left': [],
+            'left': [self.stats_panel],
             'right': [self.img_window],
             'bottom': [self.view_panel]}
-        # Start display thread
-        self.img_thread = threading.Thread(target=self._display_loop)
-        self.img_thread.daemon = True
-        self.img_thread.start()
+        # Start display thread(s)
+        if pipelined:
+            self.pipeline.start()
+        else:
+            self.img_thread = threading.Thread(target=self._display_loop)
+            self.img_thread.daemon = True
+            self.img_thread.start()
 
     def _display_loop(self):
         ''' Run method for image display thread '''
         # Caching (avoids extra lookups, probably useless)
-        display_put = self.display_queue.put
-        img_window = self.img_window
-        img_processes = self.img_processes
+        process_frame = self.pipeline.process_frame
+        show_img = self.show_img
         img_get = self.img_queue.get
         wait = self.img_show.wait
-        view_panel = self.view_panel
-        full_window = view_panel.full_frame.img_window
+        add = self.pipeline.stats.add
+        clock = time.perf_counter
         while True:
             # Get image once available
             wait()
-            sensor_img = img_get()
-            # Process full-frame image
-            for process in img_processes['full']:
-                sensor_img = process(sensor_img)
-            # Save a copy for other functions to access
-            self.image = sensor_img.copy()
-            # Convert to 8-bit
-            if sensor_img.dtype == np.uint16:
-                sensor_img = (sensor_img >> 8).astype(np.uint8)
-            # Get target window and resize
-            window = full_window if view_panel.full_btn else img_window
-            display_img = cv2.resize(
-                sensor_img, tuple(window.GetSize()),
-                interpolation=cv2.INTER_AREA)
-            # Process resized image
-            for process in img_processes['resized']:
-                display_img = process(display_img)
-            # Send to window as RGB
-            # NOTE: calls refresh *before* making image available
-            window.Refresh()
-            display_put(to_rgb(display_img))
-            view_panel.frames += 1
+            t0 = clock()
+            frame = img_get()
+            add('wait: full', clock() - t0)
+            # Process full-frame image, resize, process resized image
+            show_img(process_frame(frame))
+
+    def show_img(self, frame, timeout=None):
+        ''' Send processed RGB Frame to current display window, raise
+            queue.Full if the window doesn't take it within timeout '''
+        # NOTE: calls refresh *before* making image available
+        self.display_window().Refresh()
+        self.display_queue.put(frame, timeout=timeout)
+        self.view_panel.frames += 1
+
+    @property
+    def image(self):
+        ''' Read-only copy of the next full-frame image (copied on demand),
+            or of the latest one while paused '''
+        return self.pipeline.snapshot.get()
+
+    def display_window(self):
+        ''' Return window currently showing images (normal or fullscreen) '''
+        view_panel = self.view_panel
+        if view_panel.full_btn:
+            return view_panel.full_frame.img_window
+        return self.img_window
+
+    def display_size(self):
+        ''' Return size of current display window as (w, h) '''
+        return tuple(self.display_window().GetSize())
 
     def Assemble(self):
 
@@ -0,0 +1,634 @@
+import collections
+import csv
+import cv2
+import json
+import numpy as np
+import queue
+import sys
+import threading
+import time
+
+
+# Constants -------------------------------------------------------------------
+
+# Colored pixels
+BLUE_PX = np.uint8((255, 0, 0))         # BGR format for OpenCV / NumPy
+GREEN_PX = np.uint8((0, 255, 0))
+RED_PX = np.uint8((0, 0, 255))
+
+
+# Helper functions ------------------------------------------------------------
+
+def is_color(img):
+    ''' Return True if image contains a color channel, False otherwise '''
+    return len(img.shape) == 3
+
+
+def to_8bit(img, dst=None):
+    ''' Convert 16-bit image to 8-bit by dropping the low byte.
+        Writes into dst if given, in a single pass. '''
+    if img.dtype == np.uint16:
+        img = np.right_shift(img, 8, out=dst, casting='unsafe') \
+            if dst is not None else (img >> 8).astype(np.uint8)
+    return img
+
+
+def to_rgb(img, dst=None):
+    ''' Convert grayscale or BGR (OpenCV default) to RGB (wx default) '''
+    return cv2.cvtColor(
+        img, cv2.COLOR_BGR2RGB if is_color(img) else cv2.COLOR_GRAY2RGB,
+        dst=dst)
+
+
+def process_name(process):
+    ''' Return readable name of a process function, e.g. ColorPanel.process '''
+    return getattr(process, '__qualname__', None) or type(process).__name__
+
+
+def top_px(img, n=1):
+    ''' Return top nth pixel from an image '''
+    return img.max() if n == 1 else np.partition(img.flatten(), -n)[-n]
+
+
+def top_px_avg(img, n=3):
+    ''' Return average of top n pixels from an image '''
+    return img.max() if n == 1 else np.partition(img.flatten(), -n)[-n:].mean()
+
+
+# Frames ----------------------------------------------------------------------
+
+class Frame(object):
+    ''' Image with capture metadata, passed through queues by reference.
+        timestamp: capture time (time.time()), now if not given
+        seq: sequence number from the sensor, None if unknown
+        sensor: sensor id, for sequence tracking '''
+
+    __slots__ = ('img', 'timestamp', 'seq', 'sensor')
+
+    def __init__(self, img, timestamp=None, seq=None, sensor=None):
+        self.img = img
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.seq = seq
+        self.sensor = sensor
+
+
+def as_frame(item):
+    ''' Wrap bare images (e.g. from older sensors) in a Frame '''
+    return item if isinstance(item, Frame) else Frame(item)
+
+
+# Buffers ---------------------------------------------------------------------
+
+class BufferPool(object):
+    ''' Recyclable preallocated arrays, keyed by (shape, dtype).
+        get() hands out a buffer again once nothing else references it (e.g.
+        once the display has painted it), so there is no explicit release.
+        Relies on CPython reference counting. '''
+
+    def __init__(self, size=16):
+        self.size = size            # Maximum buffers kept per (shape, dtype)
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.allocated = 0          # Arrays created so far, for profiling
+        # Reference count of a buffer only referenced by the pool
+        self.free_refs = self._refs([np.empty(0)])
+
+    @staticmethod
+    def _refs(buffers):
+        ''' Reference count of first buffer, counted exactly as get() does '''
+        for buf in buffers:
+            return sys.getrefcount(buf)
+
+    def get(self, shape, dtype=np.uint8):
+        ''' Return an unused (uninitialized) array of given shape and dtype '''
+        key = (tuple(shape), np.dtype(dtype))
+        free_refs = self.free_refs
+        with self.lock:
+            buffers = self.buffers.setdefault(key, [])
+            for buf in buffers:
+                if sys.getrefcount(buf) <= free_refs:
+                    return buf
+            buf = np.empty(*key)
+            self.allocated += 1
+            if len(buffers) < self.size:
+                buffers.append(buf)
+            return buf
+
+    def clear(self):
+        ''' Forget all buffers, e.g. after the sensor format changes '''
+        with self.lock:
+            self.buffers = {}
+
+
+BUFFER_POOL = BufferPool()      # Shared by sensors and pipelines by default
+
+
+# Queues ----------------------------------------------------------------------
+
+class LatestQueue(object):
+    ''' Ring buffer with the queue.Queue interface where the newest frame wins.
+        put() never blocks or raises queue.Full: once maxsize items are
+        waiting, the oldest is overwritten and counted in self.dropped. '''
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.items = collections.deque(maxlen=maxsize)
+        self.not_empty = threading.Condition(threading.Lock())
+        self.dropped = 0        # Frames overwritten before being read
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return len(self.items) == self.maxsize
+
+    def put(self, item, block=True, timeout=None):
+        ''' Add item, overwriting the oldest if full (block is ignored) '''
+        with self.not_empty:
+            if len(self.items) == self.maxsize:
+                self.dropped += 1
+            self.items.append(item)
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        ''' Remove and return oldest item, as queue.Queue.get() '''
+        with self.not_empty:
+            if not self.items:
+                if not block or not self.not_empty.wait_for(
+                        self.qsize, timeout):
+                    raise queue.Empty
+            return self.items.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+# Snapshots -------------------------------------------------------------------
+
+class Snapshot(object):
+    ''' Copy-on-demand image snapshot.
+        The pipeline offers every frame, keeping only a reference to the
+        latest one, and copies one after a consumer has asked for it with
+        get(). Copies are read-only since they may be shared by several
+        consumers. The reference keeps that one frame's buffer from being
+        recycled by a BufferPool. '''
+
+    def __init__(self, image=None):
+        self.image = image      # Last copied image
+        self.latest = None      # Last offered image, not a copy
+        self.offered = 0        # Images offered so far
+        self.copied = 0         # Value of offered when image was copied
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def _copy(self):
+        ''' Copy latest image, with self.lock held '''
+        image = self.latest.copy()
+        image.flags.writeable = False
+        self.image = image
+        self.copied = self.offered
+
+    def offer(self, img):
+        ''' Keep img as the latest image and copy it if any consumer is
+            waiting, called for every frame '''
+        with self.lock:
+            self.latest = img
+            self.offered += 1
+            if self.requests:
+                self._copy()
+                self.requests = 0
+                self.ready.set()
+
+    def get(self, timeout=1.):
+        ''' Return copy of the next image. If none arrives within timeout
+            (e.g. while paused), return a copy of the latest offered image
+            instead, the same object again if it was copied already.
+            timeout=0 gets the latest image without waiting, e.g. from the
+            GUI thread, which may be what the producer is waiting on. '''
+        with self.lock:
+            self.requests += 1
+            self.ready.clear()
+        ready = self.ready.wait(timeout)
+        with self.lock:
+            if not ready:       # Don't copy the next image for nobody
+                self.requests = max(self.requests - 1, 0)
+            if self.latest is not None and self.copied != self.offered:
+                self._copy()
+            return self.image
+
+
+# Workers ---------------------------------------------------------------------
+
+class AnalysisPool(object):
+    ''' Run function(img) on sampled frames in background worker threads,
+        so slow analysis (e.g. FFTs) doesn't hold up the display.
+        submit() only hands over a reference. A frame is skipped if it comes
+        less than 1/rate seconds after the last accepted one (rate 0 = no
+        limit) or if all workers are busy and the queue is full.
+        Accepted frames must not be modified afterwards by the caller.
+        callback(result, timestamp) is called from the worker threads.
+        Exceptions from function or callback are counted and kept in
+        self.error, and the worker carries on with the next frame. '''
+
+    def __init__(self, function, callback, workers=2, rate=10.,
+                 timeout=0.5):
+        self.function = function
+        self.callback = callback
+        self.rate = rate            # Maximum frames per second analyzed
+        self.timeout = timeout      # Seconds between checks of self.running
+        self.queue = queue.Queue(workers)
+        self.last = 0.              # Time of last accepted frame
+        self.accepted = 0
+        self.skipped = 0            # Frames skipped because workers were busy
+        self.errors = 0             # Frames whose analysis raised
+        self.error = None           # Last exception
+        self.running = True
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work_loop, name='analysis_{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work_loop(self):
+        ''' Target process for worker threads '''
+        get = self.queue.get
+        timeout = self.timeout
+        while self.running:
+            try:
+                img, timestamp = get(timeout=timeout)
+            except queue.Empty:
+                continue
+            try:
+                self.callback(self.function(img), timestamp)
+            except Exception as e:
+                if not self.errors:
+                    print('Error: analysis failed. Details:\n', e)
+                self.errors += 1
+                self.error = e
+
+    def due(self, now=None):
+        ''' Return True if the rate allows another frame, so callers can
+            skip preparing images that submit() would drop '''
+        rate = self.rate
+        return not rate or (now or time.time()) - self.last >= 1 / rate
+
+    def submit(self, img, timestamp=None):
+        ''' Queue img for analysis if due, return True if accepted '''
+        now = time.time()
+        if not self.due(now):
+            return False
+        if timestamp is None:
+            timestamp = now
+        try:
+            self.queue.put_nowait((img, timestamp))
+        except queue.Full:
+            self.skipped += 1
+            return False
+        self.last = now
+        self.accepted += 1
+        return True
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+# Statistics ------------------------------------------------------------------
+
+class Timer(object):
+    ''' Ring buffer of the last n durations, in seconds.
+        add() is meant to be called from a single thread. '''
+
+    def __init__(self, n=1024):
+        self.times = np.zeros(n)
+        self.count = 0
+
+    def add(self, dt):
+        self.times[self.count % len(self.times)] = dt
+        self.count += 1
+
+    def summary(self):
+        ''' Return dict of count and mean / percentiles / max in ms '''
+        times = self.times[:min(self.count, len(self.times))] * 1000
+        if not len(times):
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(times, (50, 95, 99))
+        return {
+            'count': self.count, 'mean_ms': float(times.mean()),
+            'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99),
+            'max_ms': float(times.max())}
+
+
+class PipelineStats(object):
+    ''' Low-overhead latency statistics for pipeline stages and processes.
+        Timers are named '<kind>: <name>', e.g.
+            'stage: resize'     wall time of a pipeline stage
+            'wait: resized'     time a stage waited for its input
+            'full: RollingSum.add'  wall time of a registered process
+            'latency: capture to paint'  age of a Frame when finished
+        counters: dict of name -> function returning a count (e.g. dropped
+            frames), read only when a summary is made.
+        Percentiles are only computed on summary(), so timing costs two
+        clock reads and a ring buffer write. '''
+
+    FIELDS = ('count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+    def __init__(self, n=1024):
+        self.n = n
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.last_seq = {}      # Last finished sequence number per sensor
+        self.gaps = 0           # Sequence numbers never finished
+        self.counters = {'dropped: sequence gaps': lambda: self.gaps}
+
+    def add(self, name, dt):
+        ''' Record duration dt (seconds) for timer name '''
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.setdefault(name, Timer(self.n))
+        timer.add(dt)
+
+    def run(self, kind, processes, img):
+        ''' Run img through a list of processes, timing each one '''
+        add = self.add
+        clock = time.perf_counter
+        for process in processes:
+            t0 = clock()
+            img = process(img)
+            add(kind + ': ' + process_name(process), clock() - t0)
+        return img
+
+    def frame_done(self, frame, name='paint'):
+        ''' Record capture-to-name latency and sequence gaps of a Frame.
+            Call from one thread only, e.g. when a frame is painted. '''
+        self.add('latency: capture to ' + name, time.time() - frame.timestamp)
+        seq = frame.seq
+        if seq is not None:
+            last = self.last_seq.get(frame.sensor)
+            if last is not None and seq > last + 1:
+                self.gaps += seq - last - 1
+            self.last_seq[frame.sensor] = seq
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.gaps = 0
+
+    def summary(self):
+        ''' Return {'timers': {name: stats}, 'counters': {name: count}} '''
+        with self.lock:
+            timers = dict(self.timers)
+        return {
+            'timers': {n: timers[n].summary() for n in sorted(timers)},
+            'counters': {name: f() for name, f in self.counters.items()}}
+
+    def to_json(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_csv(self, fn):
+        ''' One row per timer, then one per counter (count column only) '''
+        summary = self.summary()
+        with open(fn, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('name',) + self.FIELDS)
+            for name, stats in summary['timers'].items():
+                writer.writerow(
+                    (name,) + tuple(stats.get(k, '') for k in self.FIELDS))
+            for name, count in summary['counters'].items():
+                writer.writerow((name, count))
+
+
+# Pipeline --------------------------------------------------------------------
+
+class Pipeline(object):
+    ''' Image processing chain for numpy frames, no wx required.
+        Runs the same stages as the GuiFrame display thread:
+            full -> resize (incl. 16-to-8-bit) -> resized -> rgb
+        processes: dict of process lists, e.g. GuiFrame.img_processes.
+            Only the 'full' and 'resized' lists are used here.
+        size: display size as (w, h), or a function returning one.
+            None skips resizing (headless use).
+        pool: BufferPool for stage outputs, BUFFER_POOL by default
+        high_bit: resize 16-bit images as they are and pass them to the
+            'resized' processes (e.g. ColorProcessor's 65536-entry LUT)
+            instead of dropping the low byte first. Anything still 16-bit
+            is converted by the rgb stage. This costs more than the shift
+            (a 65536-entry np.take instead of an 8-bit cv2.LUT, about 2x
+            for mono frames), for the precision of the low byte.
+        variants: list of functions variant(img, dst) that each write one RGB
+            view of the resized image into dst. With n variants, images are
+            resized to fit 1/n of the display width, keeping their aspect
+            ratio, and the rgb stage places the views side by side, centered
+            and letterboxed in the display. An extra view costs one pass
+            (e.g. a LUT) instead of a second pipeline. Empty for a single
+            plain view. 'dc' overlays (drawn by the display window) still
+            refer to the full window, not to each view.
+        Stage and process timings are collected in self.stats. '''
+
+    STAGES = ('full', 'resize', 'resized', 'rgb')
+
+    def __init__(self, processes=None, size=None, pool=None, high_bit=False):
+        if processes is None:
+            processes = {'full': [], 'resized': []}
+        self.processes = processes
+        self.size = size
+        self.pool = BUFFER_POOL if pool is None else pool
+        self.high_bit = high_bit
+        self.variants = []
+        self.frame = None           # Frame in the 'full' stage, see timestamp
+        self.snapshot = Snapshot()  # Full-frame image for other functions
+        self.stats = PipelineStats()
+
+    def get_size(self):
+        ''' Return current display size as (w, h), or None '''
+        size = self.size
+        if callable(size):
+            size = size()
+        return None if size is None else tuple(size)
+
+    def timestamp(self):
+        ''' Return capture time of the frame in the 'full' stage, or None.
+            Meant for 'full' processes, which run on that stage's thread. '''
+        frame = self.frame
+        return None if frame is None else frame.timestamp
+
+    def stages(self):
+        ''' Return list of (name, function) for each stage, in order '''
+        return [(name, getattr(self, name)) for name in self.STAGES]
+
+    # Stages ---------------------------------------
+    def full(self, img):
+        ''' Process full-frame image and offer it to snapshot consumers '''
+        img = self.stats.run('full', self.processes['full'], img)
+        self.snapshot.offer(img)
+        return img
+
+    def resize(self, img):
+        ''' Convert to 8-bit (unless high_bit) and resize to display size '''
+        get = self.pool.get
+        if img.dtype == np.uint16 and not self.high_bit:
+            img = to_8bit(img, get(img.shape, np.uint8))
+        size = self.get_size()
+        n = len(self.variants)
+        if size is not None and n:
+            # One view per variant, fit to its share of the width
+            h, w = img.shape[:2]
+            scale = min(size[0] // n / w, size[1] / h)
+            size = (max(int(w * scale), 1), max(int(h * scale), 1))
+        if size is not None:
+            img = cv2.resize(
+                img, size, get(size[::-1] + img.shape[2:], img.dtype),
+                interpolation=cv2.INTER_AREA)
+        return img
+
+    def resized(self, img):
+        ''' Process resized image '''
+        return self.stats.run('resized', self.processes['resized'], img)
+
+    def rgb(self, img):
+        ''' Convert to 8-bit RGB for display, one view per variant '''
+        get = self.pool.get
+        if img.dtype == np.uint16:
+            img = to_8bit(img, get(img.shape, np.uint8))
+        variants = self.variants
+        if not variants:
+            return to_rgb(img, get(img.shape[:2] + (3,), np.uint8))
+        # Views side by side, each centered in 1/n of the display, black
+        # borders around them (only borders are cleared, not the views)
+        n = len(variants)
+        h, w = img.shape[:2]
+        size = self.get_size() or (w * n, h)
+        width, height = max(size[0], w * n), max(size[1], h)
+        slot = width // n
+        top = (height - h) // 2
+        out = get((height, width, 3), np.uint8)
+        out[:top] = 0
+        out[top+h:] = 0
+        rows = out[top:top+h]
+        for i, variant in enumerate(variants):
+            left = i * slot + (slot - w) // 2
+            rows[:, i*slot:left] = 0
+            variant(img, rows[:, left:left+w])
+            rows[:, left+w:(i+1)*slot] = 0
+        rows[:, n*slot:] = 0
+        return out
+
+    def process_frame(self, frame):
+        ''' Run all stages in order on a Frame (or bare image), return Frame
+            holding the RGB image '''
+        frame = as_frame(frame)
+        add = self.stats.add
+        clock = time.perf_counter
+        img = frame.img
+        self.frame = frame
+        for name, stage in self.stages():
+            t0 = clock()
+            img = stage(img)
+            add('stage: ' + name, clock() - t0)
+        frame.img = img
+        return frame
+
+    def process_img(self, img):
+        ''' Run all stages in order on a single image '''
+        return self.process_frame(img).img
+
+
+class ThreadedPipeline(Pipeline):
+    ''' Pipeline with each stage running on its own worker thread.
+        Stages are linked by bounded queues, so consecutive frames overlap
+        (most cv2 calls release the GIL).
+        in_queue: queue of sensor Frames (or images), read by the first stage
+        output: function output(frame, timeout) called with each finished
+            Frame by the last stage. It may block for up to timeout seconds
+            and then raise queue.Full, and is retried until close(), so a
+            full display queue can't keep close() from returning.
+        depth: maximum number of images waiting between two stages
+        flag: optional threading.Event, first stage pauses while clear '''
+
+    def __init__(self, in_queue, output, processes=None, size=None, depth=1,
+                 flag=None, timeout=0.5, pool=None, high_bit=False):
+        super().__init__(processes, size, pool, high_bit)
+        self.in_queue = in_queue
+        self.output = output
+        self.depth = depth
+        self.flag = flag
+        self.timeout = timeout      # Seconds between checks of self.running
+        self.queues = []
+        self.threads = []
+        self.running = False
+
+    def _stage_loop(self, name, stage, get, put, flag=None):
+        ''' Target process for stage worker threads '''
+        timeout = self.timeout
+        add = self.stats.add
+        clock = time.perf_counter
+        while self.running:
+            if flag is not None and not flag.wait(timeout):
+                continue
+            t0 = clock()
+            try:
+                frame = as_frame(get(timeout=timeout))
+            except queue.Empty:
+                continue
+            t1 = clock()
+            if name == 'full':
+                self.frame = frame
+            frame.img = stage(frame.img)
+            add('wait: ' + name, t1 - t0)
+            add('stage: ' + name, clock() - t1)
+            put(frame)
+
+    def _make_put(self, put_function):
+        ''' Return blocking put function that gives up on close(), for
+            put_function(frame, timeout) raising queue.Full on timeout (e.g.
+            Queue.put or the output function) '''
+        timeout = self.timeout
+
+        def put(frame):
+            while self.running:
+                try:
+                    put_function(frame, timeout=timeout)
+                    return
+                except queue.Full:
+                    pass
+
+        return put
+
+    def start(self):
+        ''' Create queues and start one worker thread per stage '''
+        self.running = True
+        stages = self.stages()
+        self.queues = [queue.Queue(self.depth) for s in stages[1:]]
+        gets = [self.in_queue.get] + [q.get for q in self.queues]
+        puts = [self._make_put(f) for f in
+                [q.put for q in self.queues] + [self.output]]
+        self.threads = []
+        for i, (name, stage) in enumerate(stages):
+            thread = threading.Thread(
+                target=self._stage_loop, name='pipeline_' + name,
+                args=(name, stage, gets[i], puts[i],
+                      self.flag if i == 0 else None))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self.running
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.queues = []
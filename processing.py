@@ -0,0 +1,763 @@
+import cv2
+import functools
+import numpy as np
+
+from .pipeline import BUFFER_POOL, GREEN_PX, RED_PX, is_color, to_rgb
+
+
+# Frame accumulation ----------------------------------------------------------
+
+class RollingSum(object):
+    ''' Rolling combination of the last n frames, updated in place.
+        mode:
+            'sum': sum of last n frames, scaled to 16 bits (n > 1)
+            'mean': mean of last n frames, in the original dtype
+            'max': running maximum (peak hold) since the last reset
+        sum and mean keep n frames in a preallocated ring buffer (original
+        dtype) and an integer accumulator, so each frame costs one add and one
+        subtract. max keeps no frames at all. '''
+
+    MODES = ('sum', 'mean', 'max')
+
+    def __init__(self, n=2, mode='sum', pool=None):
+        self.n = n
+        self.mode = mode
+        self.pool = BUFFER_POOL if pool is None else pool
+        self.reset()
+
+    def reset(self):
+        ''' Drop all accumulated frames '''
+        self.acc = None         # Accumulator
+        self.ring = None        # Ring buffer of last n frames
+        self.index = 0          # Next ring buffer position
+        self.count = 0          # Frames in accumulator
+        self.config = None      # (n, mode, shape, dtype) of accumulator
+
+    def _setup(self, img):
+        ''' Allocate accumulator (and ring buffer) for current settings '''
+        n, mode = self.n, self.mode
+        self.reset()
+        self.config = (n, mode, img.shape, img.dtype)
+        if mode == 'max':
+            self.acc = img.copy()
+            self.count = 1
+            return
+        # Accumulator that can't overflow, int32 when possible for cv2
+        top = n * int(np.iinfo(img.dtype).max)
+        acc_dtype = np.int32 if top < 2**31 else np.uint64
+        self.acc = np.zeros(img.shape, acc_dtype)
+        self.ring = np.empty((n,) + img.shape, img.dtype)
+
+    def add(self, img):
+        ''' Add image and return the combined image '''
+        if self.config != (self.n, self.mode, img.shape, img.dtype):
+            self._setup(img)
+        acc = self.acc
+        out = self.pool.get(img.shape, img.dtype)
+        # Running maximum
+        if self.mode == 'max':
+            np.maximum(acc, img, out=acc)
+            np.copyto(out, acc)
+            return out
+        # Replace oldest frame in ring buffer and accumulator
+        ring, i = self.ring, self.index
+        if self.count == self.n:
+            np.subtract(acc, ring[i], out=acc)
+        else:
+            self.count += 1
+        np.copyto(ring[i], img)
+        np.add(acc, img, out=acc)
+        self.index = (i + 1) % self.n
+        # Mean in original dtype
+        if self.mode == 'mean':
+            np.floor_divide(acc, self.count, out=out, casting='unsafe')
+            return out
+        # Sum, scaled by its known bound rather than a full-frame max():
+        #     - n = 1: as it is, in the original dtype
+        #     - otherwise: 16-bit, with count full-scale frames at 65535, so
+        #       dtype and brightness don't change from frame to frame
+        top = self.count * int(np.iinfo(img.dtype).max)
+        if self.n == 1:
+            np.copyto(out, acc, casting='unsafe')
+        else:
+            out = self.pool.get(img.shape, np.uint16)
+            if acc.dtype == np.int32:   # As 1 channel, scalar applies to all
+                h = len(acc)
+                cv2.multiply(acc.reshape(h, -1), 1, out.reshape(h, -1),
+                             65535 / top, cv2.CV_16U)
+            else:
+                np.multiply(acc, 65535 / top, out=out, casting='unsafe')
+        return out
+
+
+# Histogram -------------------------------------------------------------------
+
+class Histogram(object):
+    ''' Pixel value histogram of a subsampled grid, computed in one pass per
+        frame and shared by range stretch, auto-contrast and live display.
+        step: sample every step-th row and column
+        hist: counts per pixel value (256 or 65536 bins, all channels).
+            Replaced on each update, never modified, so other threads can
+            read it without locking. '''
+
+    def __init__(self, step=2):
+        self.step = step
+        self.hist = None
+        self.cumsum = None      # Cumulative counts, made on demand
+
+    def update(self, img):
+        ''' Compute histogram of img, return it '''
+        s = self.step
+        rows = img[::s]
+        # 2-D view with channels side by side, calcHist is slow on (n, 1)
+        sub = rows.reshape(len(rows), -1)[:, ::s]
+        bins = int(np.iinfo(img.dtype).max) + 1
+        self.cumsum = None
+        self.hist = cv2.calcHist([sub], [0], None, [bins], (0, bins)).ravel()
+        return self.hist
+
+    def min(self):
+        ''' Lowest pixel value '''
+        return int(np.argmax(self.hist > 0))
+
+    def max(self, below=None):
+        ''' Highest pixel value, or highest below a given value, 0 if none '''
+        nonzero = np.flatnonzero(
+            self.hist if below is None else self.hist[:int(below)])
+        return int(nonzero[-1]) if nonzero.size else 0
+
+    def percentile(self, p):
+        ''' Lowest pixel value with at least p percent of samples at or below
+            it (0 gives min(), 100 gives max()) '''
+        if self.cumsum is None:
+            self.cumsum = np.cumsum(self.hist)
+        cumsum = self.cumsum
+        return int(np.searchsorted(cumsum, max(p / 100 * cumsum[-1], 1)))
+
+
+def histogram_image(hist, size, color=(255, 255, 255)):
+    ''' Render histogram as an RGB bar graph of size (w, h), log scale '''
+    w, h = size
+    edges = np.linspace(0, len(hist), w, endpoint=False).astype(int)
+    bars = np.log1p(np.add.reduceat(hist, edges))
+    top = bars.max()
+    heights = (bars * (h / top) if top else bars).astype(int)
+    mask = np.arange(h, 0, -1)[:, np.newaxis] <= heights
+    img = np.zeros((h, w, 3), np.uint8)
+    img[mask] = color
+    return img
+
+
+# Color -----------------------------------------------------------------------
+
+class ColorProcessor(object):
+    ''' Display color processing, as used by ColorPanel.
+        8-bit images are processed step by step, or with one fused table.
+        16-bit images always use a fused 65536-entry table, which converts
+        them to 8-bit in the same pass (range and gamma are computed before
+        any bits are dropped).
+        colormap: index in COLORMAPS (0 = force gray, 1 = no mapping,
+            2 and up = OpenCV colormap 0 and up)
+        range_val: stretch dynamic range from 0 to this value, None = off
+        gamma_val: gamma curve exponent (1/gamma), None = off
+        sat_val: highlight pixels at or above this value red, None = off
+            (8-bit value, the top byte is compared for 16-bit images)
+        sat_full: find saturated pixels in the full-resolution frame (with
+            find_sat_full as a 'full' process) and keep any pixel that is
+            saturated within each display pixel, so small spots survive
+            resizing. The mask may lag the image by a frame when stages run
+            on separate threads.
+        auto_clip: with range on, stretch between percentiles auto_clip and
+            100 - auto_clip of the histogram instead of min and max
+        histogram: Histogram computed once per frame when range is on (or
+            always, if show_histogram) and read by all steps.
+        fused: compose range, gamma and colormap into one table, rebuilt only
+            when settings or image min/max change, and apply it in a single
+            pass per frame instead of one pass per step '''
+
+    COLORMAPS = (               # defined to match OpenCV indices
+        'force gray',
+        'no mapping',
+        'autumn',
+        'bone',
+        'cool',
+        'hot',
+        'HSV',
+        'jet',
+        'ocean',
+        'pink',
+        'rainbow',
+        'sping',
+        'summer',
+        'winter')
+    RNG8 = np.arange(0, 256)    # Pixel values for range_img
+    RNG16 = np.arange(0, 65536)
+
+    def __init__(self, colormap=1, range_val=None, gamma_val=None,
+                 sat_val=None, fused=False, auto_clip=None,
+                 show_histogram=False, sat_full=False, pool=None):
+        self.colormap = colormap
+        self.range_val = range_val
+        self.gamma_val = None
+        self.gamma_lut = None
+        self.lut_gamma = None       # Gamma value of self.gamma_lut
+        self.set_gamma(gamma_val)
+        self.sat_val = sat_val
+        self.sat_map = None         # uint8 mask, 255 = saturated
+        self.sat_full = sat_full
+        self.full_sat_map = None    # Mask of last full-resolution frame
+        self.red = None             # Solid RED_PX image to copy from
+        self.pool = BUFFER_POOL if pool is None else pool
+        self.fused = fused
+        self.fused_lut = None
+        self.fused_key = None       # Settings and min/max of self.fused_lut
+        self.auto_clip = auto_clip
+        self.histogram = Histogram()
+        self.show_histogram = show_histogram
+
+    def set_gamma(self, gamma):
+        ''' Set gamma value, creating look-up table (LUT) if it changed '''
+        if gamma is not None and gamma != self.lut_gamma:
+            self.gamma_lut = (np.arange(0, 1, 1/256) ** (1/gamma) * 255 + 0.5
+                              ).astype(np.uint8)
+            self.lut_gamma = gamma
+        self.gamma_val = gamma
+
+    def is_sat(self):
+        ''' Check if saturated pixel highlighting is active and ready '''
+        return self.sat_val is not None \
+            and isinstance(self.sat_map, np.ndarray)
+
+    def colormap_img(self, img):
+        ''' Apply selected colormap by index '''
+        colormap = self.colormap - 2
+        if colormap > -1:                           # Colormap
+            img = cv2.applyColorMap(img, colormap)
+        elif colormap == -2 and is_color(img):      # Force gray
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
+    def range_img(self, img):
+        ''' Stretch dynamic range to be from 0 to self.range_val '''
+        if self.range_val is not None:
+            mn, mx = self.min_max(img)
+            lut = self.RNG8 - mn
+            if mx > mn:
+                lut = lut * self.range_val / (mx - mn)
+            img = cv2.LUT(img, np.clip(lut, 0, 255).astype(np.uint8))
+        return img
+
+    def gamma_img(self, img):
+        ''' Apply gamma curve using lookup table '''
+        if self.gamma_val is not None:
+            img = cv2.LUT(img, self.gamma_lut)
+        return img
+
+    def sat_top(self, dtype):
+        ''' Return sat_val for images of dtype as a Python int (GuiPanel
+            gives floats, and cv2 rejects NumPy integer thresholds) '''
+        top = int(self.sat_val)
+        return top if dtype == np.uint8 else top << 8
+
+    def sat_mask(self, img, dst=None):
+        ''' Return uint8 mask of pixels at or above sat_val in any channel '''
+        top = self.sat_top(img.dtype)
+        if not is_color(img):
+            return cv2.compare(img, top, cv2.CMP_GE, dst)
+        # All channels below threshold, inverted
+        mask = cv2.inRange(img, (0,) * 3, (top - 1,) * 3, dst)
+        return cv2.bitwise_not(mask, mask)
+
+    def find_sat_full(self, img):
+        ''' Find saturated pixels in the full-resolution frame (sat_full) '''
+        if self.sat_val is not None and self.sat_full:
+            # New buffer per frame, the last one may still be being resized
+            self.full_sat_map = self.sat_mask(
+                img, self.pool.get(img.shape[:2], np.uint8))
+        else:
+            self.full_sat_map = None
+        return img
+
+    def find_sat_img(self, img):
+        ''' Find and save locations of pixels above given threshold '''
+        if self.sat_val is not None:
+            shape = img.shape[:2]
+            dst = self.sat_map
+            if dst is None or dst.shape != shape:
+                dst = np.empty(shape, np.uint8)
+            full = self.full_sat_map
+            if self.sat_full and full is not None:
+                # Any saturated pixel within the area of a display pixel
+                dst = cv2.resize(
+                    full, shape[::-1], dst, interpolation=cv2.INTER_AREA)
+                self.sat_map = cv2.compare(dst, 0, cv2.CMP_GT, dst)
+            else:
+                self.sat_map = self.sat_mask(img, dst)
+        return img
+
+    def apply_sat_img(self, img):
+        ''' Make previously-saved pixels red '''
+        if self.is_sat():
+            if not is_color(img):
+                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            if self.red is None or self.red.shape != img.shape:
+                self.red = np.empty(img.shape, np.uint8)
+                self.red[:] = RED_PX
+            cv2.copyTo(self.red, self.sat_map, img)
+        return img
+
+    def histogram_img(self, img):
+        ''' Update histogram if anything will read it '''
+        if self.range_val is not None or self.show_histogram:
+            self.histogram.update(img)
+        return img
+
+    def min_max(self, img):
+        ''' Return (min, max) for range stretch from the histogram: clipped
+            percentiles if auto_clip, else ignoring saturated values for
+            max '''
+        histogram = self.histogram
+        if self.auto_clip is not None:
+            return (histogram.percentile(self.auto_clip),
+                    histogram.percentile(100 - self.auto_clip))
+        if self.sat_val is not None:
+            return histogram.min(), histogram.max(
+                below=self.sat_top(img.dtype))
+        return histogram.min(), histogram.max()
+
+    def make_fused_lut(self, mn=0, mx=255, colormap=-1, dtype=np.uint8):
+        ''' Return range, gamma and colormap composed into one 8-bit look-up
+            table for images of dtype: (n,) for gray or (n, 1, 3) for BGR
+            output, with n = 256 or 65536. Returns None for 8-bit if the
+            table would do nothing. '''
+        high_bit = dtype == np.uint16
+        if not high_bit and self.range_val is None and self.gamma_val is None \
+                and colormap < 0:
+            return None
+        rng = self.RNG16 if high_bit else self.RNG8
+        scale = 1/256 if high_bit else 1    # to 8-bit units
+        # Range (in 8-bit units, not yet rounded)
+        if self.range_val is not None:
+            if mx > mn:
+                scale = self.range_val / (mx - mn)
+            lut = np.clip((rng - mn) * scale, 0, 255)
+        else:
+            lut = rng * scale
+        # Gamma, on unrounded values for 16-bit
+        if self.gamma_val is None:
+            lut = lut.astype(np.uint8)
+        elif high_bit:
+            lut = ((lut / 256) ** (1/self.gamma_val) * 255 + 0.5
+                   ).astype(np.uint8)
+        else:
+            lut = self.gamma_lut[lut.astype(np.uint8)]
+        # Colormap
+        if colormap > -1:
+            lut = cv2.applyColorMap(lut.reshape(-1, 1), colormap)
+        return lut
+
+    def fused_img(self, img):
+        ''' Apply range, gamma and colormap with a single cached table.
+            Returns an 8-bit image, also for 16-bit input. '''
+        colormap = self.colormap - 2
+        mn, mx = self.min_max(img) if self.range_val is not None else (0, 0)
+        # Colormaps of color images convert to gray first, so map separately
+        table_colormap = -1 if is_color(img) else colormap
+        key = (self.range_val, self.gamma_val, table_colormap, mn, mx,
+               img.dtype)
+        if key != self.fused_key:
+            self.fused_lut = self.make_fused_lut(
+                mn, mx, table_colormap, img.dtype)
+            self.fused_key = key
+        lut = self.fused_lut
+        if img.dtype == np.uint16:                  # cv2.LUT is 8-bit only
+            lut = lut.reshape(lut.shape[:1] + lut.shape[2:])
+            img = np.take(lut, img, axis=0)
+            if lut.ndim == 2:                       # Gray to colormap
+                return img
+        elif lut is not None and lut.ndim == 3:     # Gray to colormap
+            return cv2.applyColorMap(img, lut)
+        elif lut is not None:
+            img = cv2.LUT(img, lut)
+        if colormap > -1 and table_colormap == -1:  # Colormap of color image
+            return cv2.applyColorMap(img, colormap)
+        if colormap == -2 and is_color(img):        # Force gray
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
+    def process_img(self, img):
+        ''' Run all color processes in order '''
+        if self.fused or img.dtype == np.uint16:
+            processes = (
+                self.histogram_img,
+                self.find_sat_img,
+                self.fused_img,
+                self.apply_sat_img)
+        else:
+            processes = (
+                self.histogram_img,
+                self.find_sat_img,
+                self.range_img,
+                self.gamma_img,
+                self.colormap_img,
+                self.apply_sat_img)
+        for process in processes:
+            img = process(img)
+        return img
+
+
+def colormap_variant(colormap=1):
+    ''' Return display variant for Pipeline.variants that applies one of
+        ColorProcessor.COLORMAPS to the shared resized image. Colormaps are
+        a single LUT pass (table in RGB order) straight into the output. '''
+    colormap -= 2
+    if colormap > -1:
+        rng = np.arange(256, dtype=np.uint8).reshape(256, 1)
+        lut = np.ascontiguousarray(cv2.applyColorMap(rng, colormap)[..., ::-1])
+
+        def variant(img, dst):
+            cv2.applyColorMap(img, lut, dst)
+    else:
+        def variant(img, dst):
+            if colormap == -2 and is_color(img):    # Force gray
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            to_rgb(img, dst)
+
+    return variant
+
+
+# Flat field ------------------------------------------------------------------
+
+def average_frames(frames, n):
+    ''' Return float32 mean of the first n images from an iterable, and
+        their dtype. Raises ValueError if it has fewer than n. '''
+    acc = None
+    count = 0
+    for count, img in enumerate(frames, 1):
+        if acc is None:
+            acc = np.zeros(img.shape, np.float64)
+            dtype = img.dtype
+        cv2.accumulate(img, acc)
+        if count == n:
+            return (acc / count).astype(np.float32), dtype
+    raise ValueError('only {} of {} frames to average'.format(count, n))
+
+
+class FlatField(object):
+    ''' Flat field correction, as used by FlatFieldPanel.
+        ff: dark frame, subtracted from each image (rounded to the image
+            dtype, which is several times faster than subtracting floats)
+        flat: frame of uniform illumination (float32)
+        mode: 'subtract' only subtracts ff, 'divide' also multiplies by a
+            gain map, mean(flat - ff) / (flat - ff), precomputed by set_flat
+        dtype: dtype of the images the frames were taken from
+        Outputs are written into pooled buffers. '''
+
+    MODES = ('subtract', 'divide')
+    DEPTHS = {np.dtype(np.uint8): cv2.CV_8U, np.dtype(np.uint16): cv2.CV_16U}
+
+    def __init__(self, ff=None, flat=None, mode='subtract', dtype=None,
+                 pool=None):
+        self.ff = None
+        self.flat = None
+        self.gain = None
+        self.dtype = None
+        self.mode = mode
+        self.pool = BUFFER_POOL if pool is None else pool
+        if ff is not None:
+            self.set_dark(ff, dtype)
+        if flat is not None:
+            self.set_flat(flat, dtype or self.dtype)
+
+    def set_dark(self, ff, dtype=None):
+        ''' Set dark frame, e.g. from average_frames '''
+        self.dtype = dtype = np.dtype(dtype or ff.dtype)
+        if ff.dtype != dtype:
+            ff = np.clip(ff + 0.5, 0, np.iinfo(dtype).max).astype(dtype)
+        self.ff = ff
+        self.update_gain()
+
+    def set_flat(self, flat, dtype=None):
+        ''' Set flat frame, e.g. from average_frames '''
+        self.flat = flat
+        self.dtype = np.dtype(dtype or flat.dtype)
+        self.update_gain()
+
+    def set_frames(self, dtype, ff=None, flat=None, gain=None):
+        ''' Set all frames at once, e.g. from CalibrationStore.load(). The
+            gain map is only computed if not given. '''
+        self.dtype = np.dtype(dtype)
+        self.ff = ff
+        self.flat = flat
+        if gain is None:
+            self.update_gain()
+        else:
+            self.gain = gain
+
+    def frames(self):
+        ''' Return dict of frames, e.g. for CalibrationStore.save() '''
+        return {'ff': self.ff, 'flat': self.flat, 'gain': self.gain}
+
+    def update_gain(self):
+        ''' Precompute float32 gain map from flat and dark frames '''
+        flat, ff = self.flat, self.ff
+        if flat is None or (ff is not None and ff.shape != flat.shape):
+            self.gain = None
+            return
+        signal = flat.astype(np.float32)
+        if ff is not None:
+            signal -= ff
+        np.maximum(signal, 1, out=signal)       # Dead pixels, avoid / 0
+        self.gain = signal.mean() / signal
+
+    def matches(self, img):
+        ''' Check if frames for the current mode exist and have the image
+            size and dtype '''
+        frames = [self.ff]
+        if self.mode == 'divide':
+            frames = [self.gain] + ([self.ff] if self.ff is not None else [])
+        return img.dtype == self.dtype and all(
+            f is not None and f.shape == img.shape for f in frames)
+
+    def flatfield_img(self, img):
+        get = self.pool.get
+        depth = self.DEPTHS[img.dtype]
+        # Both clip between 0 and dtype max
+        if self.ff is not None:
+            img = cv2.subtract(img, self.ff, get(img.shape, img.dtype))
+        if self.mode == 'divide' and self.gain is not None:
+            img = cv2.multiply(
+                img, self.gain, get(img.shape, img.dtype), dtype=depth)
+        return img
+
+
+# Fringes ---------------------------------------------------------------------
+
+class FringeAnalyzer(object):
+    ''' Fringe count, contrast and tilt of a grayscale image, as used by
+        FringePanel '''
+
+    def __init__(self, dc_mask=2):
+        self.dc_mask = dc_mask      # pixels
+
+    def analyze(self, img):
+        ''' Return (count, contrast, tilt) of fringes in img '''
+        # Smoothing
+        img2 = cv2.GaussianBlur(img, (0, 0), 3)
+
+        # Fringe contrast
+        h, w = img2.shape
+        x, y, r = int(w/2), int(h/2), int(w/5)
+        chunk = img2[x-r:x+r, y-r:y+r]
+        contrast = (int(chunk.max()) - int(chunk.min())) \
+            / np.iinfo(img.dtype).max
+
+        # Fringe count / tilt
+        # DFT
+        fft = np.fft.fftshift(np.abs(np.fft.rfft2(img2)))
+        # DC mask
+        h, w = fft.shape
+        x_c, y_c, dc = int(w/2), int(h/2), self.dc_mask
+        fft[y_c-dc:y_c+dc, x_c-dc:x_c+dc] = 0
+        # Find peak
+        y_max, x_max = np.unravel_index(fft.argmax(), fft.shape)
+        x_dist, y_dist = x_max - x_c, y_max - y_c
+        # Count
+        n = np.sqrt(x_dist*x_dist + y_dist*y_dist)
+        # Tilt
+        tilt = np.degrees(y_dist/x_dist + np.pi) if x_dist else 90.0
+
+        return n, contrast, tilt
+
+
+class FringeEstimator(object):
+    ''' Sub-bin fringe count, contrast and tilt of a grayscale image, with
+        the same interface as FringeAnalyzer.
+        The image is Hann-windowed, zero-padded to even
+        cv2.getOptimalDFTSize dimensions and transformed with a real cv2.dft
+        (packed CCS output, several times faster than complex output). The
+        spectral peak is refined by Gaussian (log-parabolic) interpolation,
+        and contrast taken from the energy of its main lobe. Windows and DC
+        masks are cached per image shape. Results use the parameters of
+        synthetic.fringe_image:
+            count: fringes across the frame along the wave vector (cycles
+                per width along x, per height along y)
+            contrast: (max - min) / full scale
+            tilt: angle of the wave vector from the x axis, degrees in
+                (-90, 90]
+        dc_mask: bins around DC to ignore (low-frequency background) '''
+
+    def __init__(self, dc_mask=2):
+        self.dc_mask = dc_mask
+        self.cache = {}     # shape: (window, energy, DFT size, DC mask)
+
+    def _setup(self, shape):
+        ''' Create and cache window and DC mask for an image shape '''
+        h, w = shape
+        window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+        size = tuple(2 * cv2.getOptimalDFTSize((n + 1) // 2) for n in shape)
+        dc = self.dc_mask
+        mask = np.ones((size[0], size[1] // 2 + 1), np.float32)
+        mask[:dc+1, :dc+1] = 0
+        mask[size[0]-dc:, :dc+1] = 0
+        # Spectral energy of a cosine of amplitude 1, per half plane
+        energy = size[0] * size[1] * float((window * window).sum()) / 4
+        setup = self.cache[shape] = (window, energy, size, mask)
+        return setup
+
+    @staticmethod
+    def _magnitude(ccs):
+        ''' Return magnitude of half spectrum (x <= w/2) from a 2-D real DFT
+            packed in CCS format, for even dimensions. The Nyquist column
+            x = w/2 is left at 0. '''
+        h, w = ccs.shape
+        mag = np.zeros((h, w // 2 + 1), np.float32)
+        # 0 < x < w/2: (re, im) pairs along rows
+        cv2.magnitude(ccs[:, 1:-1:2], ccs[:, 2::2], mag[:, 1:-1])
+        # x = 0: real DFT of column 0, itself packed along y
+        col = ccs[:, 0]
+        mag[0, 0] = abs(col[0])
+        mag[h // 2, 0] = abs(col[-1])
+        mag[1:h//2, 0] = np.hypot(col[1:-1:2], col[2:-1:2])
+        mag[h//2+1:, 0] = mag[h//2-1:0:-1, 0]
+        return mag
+
+    @staticmethod
+    def _interpolate(left, center, right):
+        ''' Return offset of a Gaussian peak through 3 points '''
+        left, center, right = np.log(np.maximum((left, center, right), 1e-9))
+        d = left - 2*center + right
+        return 0.5 * (left - right) / d if d < 0 else 0.
+
+    def analyze(self, img):
+        ''' Return (count, contrast, tilt) of fringes in img '''
+        h, w = img.shape
+        setup = self.cache.get(img.shape) or self._setup(img.shape)
+        window, energy, (dft_h, dft_w), mask = setup
+        # Windowed image without its (weighted) mean, padded to DFT size
+        img2 = cv2.multiply(img, window, dtype=cv2.CV_32F)
+        img2 -= window * (img2.sum() / window.sum())
+        img2 = cv2.copyMakeBorder(
+            img2, 0, dft_h - h, 0, dft_w - w, cv2.BORDER_CONSTANT, value=0)
+        # Magnitude of half spectrum (x >= 0), DC masked
+        mag = self._magnitude(cv2.dft(img2))
+        mag *= mask
+        # Peak, refined along both axes (rows wrap around)
+        y, x = np.unravel_index(mag.argmax(), mag.shape)
+        dy = self._interpolate(mag[y-1, x], mag[y, x], mag[(y+1) % dft_h, x])
+        dx = self._interpolate(
+            mag[y, x-1], mag[y, x], mag[y, x+1]) \
+            if 0 < x < mag.shape[1] - 1 else 0.
+        ky = y + dy
+        if ky > dft_h / 2:
+            ky -= dft_h
+        # DFT bins to cycles per image width / height
+        kx = (x + dx) * w / dft_w
+        ky = ky * h / dft_h
+        count = float(np.hypot(kx, ky))
+        tilt = float(np.degrees(np.arctan2(ky, kx)))
+        # Amplitude from energy of the peak's main lobe (Parseval), which
+        # unlike its height doesn't depend on where it falls between bins
+        lobe = mag.take(range(y-2, y+3), 0, mode='wrap')[:, max(x-2, 0):x+3]
+        amplitude = float(np.sqrt((lobe * lobe).sum() / energy))
+        contrast = 2 * amplitude / np.iinfo(img.dtype).max
+        return count, contrast, tilt
+
+
+def decimate_roi(img, roi=None, size=(256, 256)):
+    ''' Return a new grayscale image of fixed size (w, h) for analysis,
+        area-averaged from a region of img.
+        roi: (x0, y0, x1, y1) as fractions of the width and height, None for
+            the whole image
+        Fringe counts are per width and height, so FringeEstimator results
+        on it don't depend on the ROI aspect ratio or the sensor size. '''
+    if roi is not None:
+        h, w = img.shape[:2]
+        x0, y0, x1, y1 = roi
+        x0, y0 = int(x0 * w), int(y0 * h)
+        img = img[y0:max(int(y1 * h), y0 + 1), x0:max(int(x1 * w), x0 + 1)]
+    img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+    if is_color(img):
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return img
+
+
+class FringeHistory(object):
+    ''' Ring buffer of the last n fringe results, rows of
+        (timestamp, count, contrast, tilt).
+        add() is meant to be called from a single thread. Other threads may
+        read without locking: a row is only counted once written, and rows
+        are only overwritten n results later. '''
+
+    COLUMNS = ('timestamp', 'count', 'contrast', 'tilt')
+
+    def __init__(self, n=65536):
+        self.data = np.zeros((n, len(self.COLUMNS)))
+        self.count = 0
+
+    def add(self, row):
+        self.data[self.count % len(self.data)] = row
+        self.count += 1
+
+    def rows(self, seconds=None):
+        ''' Return copy of stored rows in time order, optionally only those
+            within seconds of the latest one '''
+        count, n = self.count, len(self.data)
+        if count <= n:
+            rows = self.data[:count].copy()
+        else:
+            i = count % n
+            rows = np.concatenate((self.data[i:], self.data[:i]))
+        if seconds is not None and len(rows):
+            rows = rows[rows[:, 0] >= rows[-1, 0] - seconds]
+        return rows
+
+    def stats(self, seconds=None):
+        ''' Return (mean, std) of (count, contrast, tilt), None if empty '''
+        rows = self.rows(seconds)[:, 1:]
+        if not len(rows):
+            return None
+        return rows.mean(0), rows.std(0)
+
+    def save_csv(self, fn):
+        np.savetxt(
+            fn, self.rows(), '%.6f', ',', header=','.join(self.COLUMNS),
+            comments='')
+
+
+def strip_chart(times, values, size, seconds, color=(255, 255, 255)):
+    ''' Render values against times as an RGB line graph of size (w, h),
+        covering the last seconds up to the latest time, autoscaled '''
+    w, h = size
+    img = np.zeros((h, w, 3), np.uint8)
+    if len(values) < 2:
+        return img
+    lo, hi = values.min(), values.max()
+    x = (times - (times[-1] - seconds)) * ((w - 1) / seconds)
+    y = (h - 1) * (0.5 if hi == lo else (hi - values) / (hi - lo))
+    points = np.column_stack((x, y)).round().astype(np.int32)
+    cv2.polylines(img, [points], False, color)
+    return img
+
+
+@functools.lru_cache(maxsize=8)
+def line_template(w, dtype, color):
+    ''' Return read-only row of w full-scale pixels (green if color) '''
+    top = np.iinfo(dtype).max
+    if color:
+        row = np.tile(GREEN_PX.astype(dtype) * (top // 255), (w, 1))
+    else:
+        row = np.full(w, top, dtype)
+    row.flags.writeable = False
+    return row
+
+
+def draw_lines(img, n):
+    ''' Draw n evenly spaced reference lines across left half of image '''
+    h, w = img.shape[:2]
+    d = max(int(h/(n+1) + 0.5), 1)
+    # All lines at once, through a strided view of rows d, 2d, ... n*d.
+    # Copying a cached row is much faster than broadcasting a color pixel.
+    img[d:min(int(n)*d + 1, h):d, :w//2] = line_template(
+        w//2, img.dtype, is_color(img))
+    return img
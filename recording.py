@@ -0,0 +1,371 @@
+import cv2
+import glob
+import json
+import numpy as np
+import os
+import queue
+import threading
+import time
+
+from .pipeline import BufferPool
+
+
+# Writers ---------------------------------------------------------------------
+
+class PngWriter(object):
+    ''' Write frames as a series of numbered PNG images: <prefix><n>.png '''
+
+    def __init__(self, prefix, start=1, compression=0):
+        self.prefix = prefix
+        self.start = start
+        self.params = (cv2.IMWRITE_PNG_COMPRESSION, compression)
+
+    def write(self, index, img, timestamp):
+        cv2.imwrite(
+            self.prefix + str(self.start + index) + '.png', img, self.params)
+
+    def close(self):
+        pass
+
+
+class PngReader(object):
+    ''' Read a series of numbered PNG images, as saved by PngWriter.
+        path: directory, or prefix of one series (e.g. 'frames/3_')
+        PNG files have no capture times, so timestamps is None. '''
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, '')
+        fns = glob.glob(glob.escape(path) + '*.png')
+        self.fns = sorted(fns, key=self._frame_number)
+        self.timestamps = None
+
+    @staticmethod
+    def _frame_number(fn):
+        ''' Sort key: series and frame number from '<series>_<frame>.png' '''
+        name = os.path.basename(fn)[:-4]
+        return tuple(int(n) if n.isdigit() else 0 for n in name.split('_'))
+
+    def __len__(self):
+        return len(self.fns)
+
+    def __getitem__(self, index):
+        return cv2.imread(self.fns[index], cv2.IMREAD_UNCHANGED)
+
+    def close(self):
+        pass
+
+
+# Raw video container ---------------------------------------------------------
+#
+# Layout:
+#   0       magic (8 bytes)
+#   8       frame count (uint64, updated after every frame)
+#   16      JSON metadata (shape, dtype), padded with spaces to RAW_HEADER
+#   RAW_HEADER  records: (timestamp float64, image bytes) per frame
+
+RAW_MAGIC = b'LGRAW01\n'
+RAW_HEADER = 4096
+
+
+def raw_record_dtype(shape, dtype):
+    ''' Return numpy dtype of one raw container record '''
+    return np.dtype([('timestamp', '<f8'), ('image', dtype, tuple(shape))])
+
+
+class RawWriter(object):
+    ''' Append frames to a preallocated, memory-mapped raw video file.
+        Shape and dtype are taken from the first frame; the file grows by
+        doubling its capacity when full and is trimmed on close().
+        Frames of another shape or dtype (e.g. a ROI change, or a rolling
+        sum switching to 16-bit) are rejected: write() returns False and
+        counts them in self.dropped. Later frames move up to leave no gap,
+        as long as they arrive in order (one writer thread). '''
+
+    def __init__(self, fn, capacity=256):
+        self.fn = fn
+        self.capacity = capacity    # Frames preallocated
+        self.count = 0
+        self.dropped = 0            # Frames rejected for shape or dtype
+        self.records = None         # np.memmap of records
+        self.header = None          # np.memmap of frame count
+        self.lock = threading.Lock()
+
+    def _create(self, img):
+        ''' Write header and preallocate file for first frame '''
+        meta = json.dumps({'shape': img.shape, 'dtype': img.dtype.str})
+        with open(self.fn, 'wb') as f:
+            f.write(RAW_MAGIC)
+            f.write(np.uint64(0).tobytes())
+            f.write(meta.encode().ljust(RAW_HEADER - 16))
+        self.header = np.memmap(
+            self.fn, np.uint64, 'r+', offset=len(RAW_MAGIC), shape=(1,))
+        self.dtype = raw_record_dtype(img.shape, img.dtype)
+        self._map()
+
+    def _map(self):
+        ''' (Re)map records for current capacity, growing file if needed '''
+        if self.records is not None:
+            self.records.flush()
+        self.records = np.memmap(
+            self.fn, self.dtype, 'r+', offset=RAW_HEADER,
+            shape=(self.capacity,))
+
+    def write(self, index, img, timestamp):
+        ''' Write img as frame index, return False if rejected '''
+        with self.lock:
+            if self.records is None:
+                self._create(img)
+            image = self.dtype['image']
+            if img.shape != image.shape or img.dtype != image.base:
+                self.dropped += 1
+                return False
+            index -= self.dropped
+            if index >= self.capacity:
+                while index >= self.capacity:
+                    self.capacity *= 2
+                self._map()
+            record = self.records[index]
+            record['timestamp'] = timestamp
+            record['image'] = img
+            if index >= self.count:
+                self.count = index + 1
+                self.header[0] = self.count
+            return True
+
+    def close(self):
+        ''' Flush and trim file to the frames actually written '''
+        with self.lock:
+            if self.records is None:
+                return
+            self.records.flush()
+            self.header.flush()
+            self.records = self.header = None
+            with open(self.fn, 'r+b') as f:
+                f.truncate(RAW_HEADER + self.count * self.dtype.itemsize)
+
+
+class RawReader(object):
+    ''' Read a raw video file as zero-copy (read-only) numpy views.
+        frames: array of shape (n,) + frame shape
+        timestamps: array of capture times, in seconds since the epoch '''
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            if f.read(len(RAW_MAGIC)) != RAW_MAGIC:
+                raise ValueError("Not a raw video file: {}".format(fn))
+            count = int(np.frombuffer(f.read(8), np.uint64)[0])
+            meta = json.loads(f.read(RAW_HEADER - 16).decode())
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        if count:
+            self.records = np.memmap(
+                fn, raw_record_dtype(self.shape, self.dtype), 'r',
+                offset=RAW_HEADER, shape=(count,))
+            self.frames = self.records['image']
+            self.timestamps = self.records['timestamp']
+        else:   # np.memmap can't map zero bytes
+            self.records = None
+            self.frames = np.empty((0,) + self.shape, self.dtype)
+            self.timestamps = np.empty(0)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def close(self):
+        self.records = None
+        self.frames = self.timestamps = None
+
+
+def open_recording(path):
+    ''' Return reader for a raw video file or a PNG series '''
+    if os.path.isfile(path):
+        return RawReader(path)
+    return PngReader(path)
+
+
+# Recorder --------------------------------------------------------------------
+
+class FrameRecorder(object):
+    ''' Record frames without waiting on disk.
+        record() copies each frame into a bounded queue and returns at once.
+        Writer threads encode and write in the background (cv2.imwrite
+        releases the GIL). If the queue is full, the frame is dropped and
+        counted instead of blocking the caller.
+        writer: object with write(index, img, timestamp) and close(). A
+            write() returning False (rejected frame) counts as dropped. '''
+
+    def __init__(self, writer, threads=2, size=64):
+        self.writer = writer
+        self.queue = queue.Queue(size)
+        self.pool = BufferPool(size + threads)  # Copies of queued frames
+        self.lock = threading.Lock()
+        self.running = True
+        self.frames = 0         # Frames accepted
+        self.written = 0        # Frames written to disk
+        self.dropped = 0        # Frames dropped: queue full or rejected
+        self.errors = 0         # Frames whose write raised
+        self.error = None       # Last exception
+        self.bytes = 0          # Bytes written (uncompressed)
+        self.start_time = time.time()
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._write_loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _write_loop(self):
+        ''' Target process for writer threads, exits once closed and empty.
+            Failed writes (e.g. disk full) are counted and the thread goes
+            on, so the last one out still closes (and trims) the file. '''
+        get = self.queue.get
+        try:
+            while True:
+                try:
+                    index, img, timestamp = get(timeout=0.5)
+                except queue.Empty:
+                    if not self.running:
+                        break
+                    continue
+                try:
+                    written = self.writer.write(index, img, timestamp)
+                except Exception as e:
+                    with self.lock:
+                        if not self.errors:
+                            print('Error: writing frame failed. Details:\n', e)
+                        self.errors += 1
+                        self.error = e
+                    continue
+                with self.lock:
+                    if written is not False:
+                        self.written += 1
+                        self.bytes += img.nbytes
+                    else:
+                        self.dropped += 1
+        finally:
+            # Last thread out closes the writer
+            with self.lock:
+                self.threads.pop()
+                if not self.threads:
+                    self.writer.close()
+
+    def record(self, img, timestamp=None):
+        ''' Queue copy of img for writing, return False if dropped '''
+        if not self.running or self.queue.full():
+            self.dropped += 1
+            return False
+        buf = self.pool.get(img.shape, img.dtype)
+        np.copyto(buf, img)
+        try:
+            self.queue.put_nowait((
+                self.frames, buf,
+                time.time() if timestamp is None else timestamp))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.frames += 1
+        return True
+
+    def stats(self):
+        ''' Return dict of queued and dropped frames and write rate '''
+        elapsed = time.time() - self.start_time
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'mb_per_s': self.bytes / 1e6 / elapsed if elapsed else 0.}
+
+    def close(self, wait=False):
+        ''' Stop accepting frames; writers finish the queue in background '''
+        self.running = False
+        if wait:
+            for thread in list(self.threads):
+                thread.join()
+
+
+# Calibration -----------------------------------------------------------------
+
+CALIBRATION_DIR = os.path.join(os.path.expanduser('~'), '.calibration')
+
+
+class CalibrationStore(object):
+    ''' Calibration frames (e.g. flat field dark, flat and gain maps) saved
+        as .npy files and memory-mapped on load, so loading reads nothing
+        until a frame is used.
+        Files: <root>/<sensor>/<h>x<w>[x<channels>]_<dtype>_<roi>/<name>.npy
+        roi: (x, y, w, h) of the sensor region used, as from device.roi(None)
+            (fractions of the full frame), or None for full frame '''
+
+    def __init__(self, root=CALIBRATION_DIR):
+        self.root = root
+
+    @staticmethod
+    def key_name(shape, dtype, roi=None):
+        ''' Return directory name for a frame format '''
+        return '{}_{}_{}'.format(
+            'x'.join(str(n) for n in shape), np.dtype(dtype).name,
+            'full' if roi is None else '_'.join(repr(float(n)) for n in roi))
+
+    @staticmethod
+    def parse_key_name(name):
+        ''' Return (shape, dtype, roi) from key_name() '''
+        shape, dtype, roi = name.split('_', 2)
+        return (
+            tuple(int(n) for n in shape.split('x')), np.dtype(dtype),
+            None if roi == 'full' else
+            tuple(float(n) for n in roi.split('_')))
+
+    def path(self, sensor, shape, dtype, roi=None):
+        return os.path.join(
+            self.root, str(sensor), self.key_name(shape, dtype, roi))
+
+    def save(self, sensor, shape, dtype, frames, roi=None):
+        ''' Save dict of name: array (None entries are removed) '''
+        drn = self.path(sensor, shape, dtype, roi)
+        os.makedirs(drn, exist_ok=True)
+        for name, frame in frames.items():
+            fn = os.path.join(drn, name + '.npy')
+            if frame is None:
+                if os.path.exists(fn):
+                    os.remove(fn)
+                continue
+            # Replace atomically, old file may still be memory-mapped
+            tmp_fn = os.path.join(drn, name + '.tmp.npy')
+            np.save(tmp_fn, np.ascontiguousarray(frame))
+            os.replace(tmp_fn, fn)
+
+    def load(self, sensor, shape, dtype, roi=None):
+        ''' Return dict of name: read-only memory-mapped array '''
+        return self._load_dir(self.path(sensor, shape, dtype, roi))
+
+    def load_sensor(self, sensor):
+        ''' Return {(shape, dtype, roi): frames} of every saved format of a
+            sensor, e.g. when it is selected '''
+        drn = os.path.join(self.root, str(sensor))
+        calibrations = {}
+        if os.path.isdir(drn):
+            for name in sorted(os.listdir(drn)):
+                try:
+                    key = self.parse_key_name(name)
+                except (ValueError, TypeError):
+                    continue
+                calibrations[key] = self._load_dir(os.path.join(drn, name))
+        return calibrations
+
+    @staticmethod
+    def _load_dir(drn):
+        frames = {}
+        for fn in glob.glob(os.path.join(glob.escape(drn), '*.npy')):
+            name = os.path.basename(fn)[:-4]
+            if not name.endswith('.tmp'):
+                frames[name] = np.load(fn, mmap_mode='r')
+        return frames
@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+
+
+# Constants -------------------------------------------------------------------
+
+SHAPE = (800, 1280)     # (h, w), same as gui.SZ_IMAGE reversed for NumPy
+
+
+# Helper functions ------------------------------------------------------------
+
+def _scale(img, dtype):
+    ''' Convert float image in [0, 1] to full range of an integer dtype '''
+    top = np.iinfo(dtype).max
+    return (np.clip(img, 0, 1) * top + 0.5).astype(dtype)
+
+
+# Patterns --------------------------------------------------------------------
+# All generators take (shape, dtype, step, rng, **params) and return a mono
+# image. step in [0, 1) animates deterministic patterns across a frame bank,
+# rng (np.random.Generator) is used for anything random.
+
+def fringe_image(shape=SHAPE, dtype=np.uint8, step=0., rng=None, count=10.,
+                 tilt=0., contrast=1., noise=0.):
+    ''' Straight interference fringes with known ground truth.
+        count: fringes across the frame along the wave vector, in FFT bins
+            (cycles per width along x, cycles per height along y)
+        tilt: angle of the wave vector from the x axis, degrees (0 means
+            vertical fringes)
+        contrast: (max - min) / full scale
+        noise: standard deviation of added gaussian noise, / full scale
+        step: fraction of a fringe period to shift the phase by '''
+    h, w = shape[:2]
+    t = np.radians(tilt)
+    y, x = np.ogrid[:h, :w]
+    phase = 2 * np.pi * (
+        count * np.cos(t) * x / w + count * np.sin(t) * y / h + step)
+    img = 0.5 + 0.5 * contrast * np.cos(phase)
+    if noise:
+        img = img + (rng or np.random.default_rng()).normal(0, noise, (h, w))
+    return _scale(img, dtype)
+
+
+def gradient_image(shape=SHAPE, dtype=np.uint8, step=0., rng=None, axis=1):
+    ''' Linear ramp from 0 to full scale along axis, shifted by step '''
+    n = shape[axis]
+    ramp = (np.arange(n) / n + step) % 1.
+    ramp = ramp[np.newaxis, :] if axis == 1 else ramp[:, np.newaxis]
+    return np.ascontiguousarray(
+        np.broadcast_to(_scale(ramp, dtype), shape[:2]))
+
+
+def spots_image(shape=SHAPE, dtype=np.uint8, step=0., rng=None, n=20,
+                radius=3, level=0.1, noise=0.02):
+    ''' Saturated spots of given radius on a dim, noisy background '''
+    rng = rng or np.random.default_rng()
+    h, w = shape[:2]
+    img = _scale(level + rng.normal(0, noise, (h, w)), dtype)
+    top = int(np.iinfo(dtype).max)
+    for x, y in zip(rng.integers(0, w, n), rng.integers(0, h, n)):
+        cv2.circle(img, (int(x), int(y)), radius, top, -1)
+    return img
+
+
+def noise_image(shape=SHAPE, dtype=np.uint16, step=0., rng=None, bits=16):
+    ''' Uniform noise using the low bits of dtype (e.g. 12-bit sensor) '''
+    rng = rng or np.random.default_rng()
+    bits = min(bits, np.iinfo(dtype).bits)
+    return rng.integers(0, 2**bits, shape[:2], dtype, endpoint=False)
+
+
+PATTERNS = {
+    'fringes': fringe_image,
+    'gradient': gradient_image,
+    'spots': spots_image,
+    'noise': noise_image}
+
+
+# Frame banks -----------------------------------------------------------------
+
+def frame_bank(pattern='fringes', n=16, shape=SHAPE, dtype=np.uint8, seed=None,
+               **params):
+    ''' Precompute n frames of a pattern (name in PATTERNS or generator) as
+        one read-only array of shape (n, h, w), to be cycled by sensors
+        without regenerating anything. '''
+    generator = PATTERNS[pattern] if isinstance(pattern, str) else pattern
+    rng = np.random.default_rng(seed)
+    bank = np.empty((n,) + tuple(shape[:2]), dtype)
+    for i in range(n):
+        bank[i] = generator(shape, dtype, i / n, rng, **params)
+    bank.flags.writeable = False
+    return bank